@@ -6,7 +6,13 @@
 # See http://github.com/tbaugis/hamster_experiments/blob/master/README.textile
 
 from collections import defaultdict
+import array
+import bisect
+import heapq
+import itertools
 import math
+import time
+import weakref
 import datetime as dt
 import gi
 
@@ -23,6 +29,7 @@ import cairo
 from gi.repository import GdkPixbuf
 
 import re
+import json
 
 try:
     from . import pytweener
@@ -30,11 +37,16 @@ except: # we can also live without tweener. Scene.animate will not work
     pytweener = None
 
 import colorsys
-from collections import deque
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 
 # lemme know if you know a better way how to get default font
-_test_label = gtk.Label("Hello")
-_font_desc = _test_label.get_style().font_desc.to_string()
+if gdk.Screen.get_default():
+    _test_label = gtk.Label("Hello")
+    _font_desc = _test_label.get_style().font_desc.to_string()
+else:
+    # no display (e.g. OffscreenScene on a headless box) - fall back to pango's
+    _font_desc = "Sans 10"
 
 
 class ColorUtils(object):
@@ -130,6 +142,117 @@ def get_gdk_rectangle(x, y, w, h):
     rect.x, rect.y, rect.width, rect.height = x or 0, y or 0, w or 0, h or 0
     return rect
 
+def _rectangle_union(a, b):
+    """union of two gdk rectangles. unlike gdk.rectangle_union, treats 0x0
+    rectangles as empty instead of stretching the result to include them"""
+    if not a.width and not a.height:
+        return b
+    if not b.width and not b.height:
+        return a
+    return gdk.rectangle_union(a, b)
+
+def _transform_box(matrix, x1, y1, x2, y2):
+    """gdk rectangle around the (x1, y1, x2, y2) box put through the matrix"""
+    xs, ys = zip(*[matrix.transform_point(x, y)
+                   for x, y in ((x1, y1), (x2, y1), (x1, y2), (x2, y2))])
+    x, y = int(math.floor(min(xs))), int(math.floor(min(ys)))
+    return get_gdk_rectangle(x, y, int(math.ceil(max(xs))) - x, int(math.ceil(max(ys))) - y)
+
+def _packed(data):
+    """returns a copy of the given coordinates as a flat array.array of
+    doubles. takes anything exposing the buffer protocol (array.array,
+    memoryview, numpy arrays), flat sequences of numbers and sequences of
+    (x, y) tuples"""
+    res = array.array("d")
+    if hasattr(data, "astype"): # numpy
+        res.frombytes(data.astype("float64", order="C").tobytes())
+        return res
+
+    try:
+        view = memoryview(data)
+    except TypeError:
+        view = None
+
+    if view is not None:
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes()).cast(view.format, view.shape)
+        raw = view.cast("B")
+        if view.format == "d":
+            res.frombytes(raw)
+        else:
+            res.extend(raw.cast(view.format))
+        return res
+
+    if len(data) and isinstance(data[0], (tuple, list)):
+        res.extend(c for point in data for c in point)
+    else:
+        res.extend(data)
+    return res
+
+def _rectangles_touch(a, b):
+    """true if the two gdk rectangles overlap or touch. as opposed to
+    gdk.rectangle_intersect, zero-height lines and zero-width columns count"""
+    return a.x <= b.x + b.width and b.x <= a.x + a.width and \
+           a.y <= b.y + b.height and b.y <= a.y + a.height
+
+def _split_query(data, size):
+    """splits query input - a single point or rectangle, a sequence of them
+    or a numpy array - into tuples of `size` numbers. returns the tuples and
+    whether just one was given"""
+    values = _packed(data)
+    single = len(values) == size and not hasattr(data[0], "__len__")
+    it = iter(values)
+    return list(zip(*[it] * size)), single
+
+def _rectangle_distance(rect, x, y):
+    """distance from the point to the closest point of the gdk rectangle"""
+    dx = max(rect.x - x, 0, x - rect.x - rect.width)
+    dy = max(rect.y - y, 0, y - rect.y - rect.height)
+    return math.hypot(dx, dy)
+
+def _point_in_polygon(x, y, polygon):
+    """even-odd test of the point against the list of (x, y) vertices"""
+    inside = False
+    x1, y1 = polygon[-1]
+    for x2, y2 in polygon:
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / float(y2 - y1) + x1:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+def _segments_cross(a, b, c, d):
+    """true if segment a-b crosses or touches segment c-d"""
+    def side(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    d1, d2 = side(c, d, a), side(c, d, b)
+    d3, d4 = side(a, b, c), side(a, b, d)
+    if ((d1 > 0 and d2 < 0) or (d1 < 0 and d2 > 0)) and \
+       ((d3 > 0 and d4 < 0) or (d3 < 0 and d4 > 0)):
+        return True
+
+    def on_segment(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and \
+               min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+
+    return (d1 == 0 and on_segment(c, d, a)) or (d2 == 0 and on_segment(c, d, b)) or \
+           (d3 == 0 and on_segment(a, b, c)) or (d4 == 0 and on_segment(a, b, d))
+
+def _rectangle_in_polygon(rect, polygon, contained = False):
+    """true if the gdk rectangle touches the polygon, or with `contained` set,
+    if it lies entirely within it"""
+    corners = [(rect.x, rect.y), (rect.x + rect.width, rect.y),
+               (rect.x + rect.width, rect.y + rect.height), (rect.x, rect.y + rect.height)]
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    crossing = any(_segments_cross(a, b, c, d)
+                   for a, b in zip(polygon, polygon[1:] + polygon[:1]) for c, d in edges)
+
+    if contained:
+        return not crossing and all(_point_in_polygon(x, y, polygon) for x, y in corners)
+
+    return crossing or _point_in_polygon(corners[0][0], corners[0][1], polygon) or \
+           rect.x <= polygon[0][0] <= rect.x + rect.width and rect.y <= polygon[0][1] <= rect.y + rect.height
+
 
 
 
@@ -195,7 +318,8 @@ class Graphics(object):
     """
     __slots__ = ('context', 'extents', 'paths', '_last_matrix',
                  '__new_instructions', '__instruction_cache', 'cache_surface',
-                 '_cache_layout')
+                 '_cache_layout', '_recording', '_cache_scale', '_cache_origin', '_version', '_ink_extents',
+                 '_ink_changes', '_surface_cache', '__weakref__')
     colors = Colors # pointer to the color utilities instance
 
     def __init__(self, context = None):
@@ -207,12 +331,49 @@ class Graphics(object):
         self.__instruction_cache = []
         self.cache_surface = None
         self._cache_layout = None
+        self._recording = None # instructions recorded for compiled drawing
+        self._cache_scale = None # resolution of the transform-tolerant bitmap cache
+        self._cache_origin = None
+        self._surface_cache = None # SurfaceCache accounting for cache_surface
+        self._version = 0 # bumped every time the instructions change
+        self._ink_extents = None # (version, extents, measured), see _get_ink_extents
+        self._ink_changes = 0 # times in a row the instructions were new when asked
 
     def clear(self):
         """clear all instructions"""
+        # the cache stays until the next draw, so that we can tell if the
+        # instructions that follow are any different
         self.__new_instructions = []
-        self.__instruction_cache = []
-        self.paths = []
+
+    def _has_instructions(self):
+        """true if there is anything to draw"""
+        if self.__new_instructions is not None:
+            return bool(self.__new_instructions)
+        return bool(self.__instruction_cache)
+
+    def _take_new_instructions(self):
+        """moves the instructions added since the last draw into the
+        instruction cache. returns True when they differ from the cached ones,
+        in which case captured paths, the recording and the bitmap cache are
+        dropped. identical instructions - a sprite that renders the same thing
+        again - keep it all"""
+        new_instructions = self.__new_instructions
+        if new_instructions is None:
+            return False
+        self.__new_instructions = None
+
+        try:
+            if new_instructions == self.__instruction_cache:
+                return False
+        except ValueError: # numpy arrays won't tell if they are equal
+            pass
+
+        self.__instruction_cache = new_instructions
+        self._version += 1
+        self.paths = None
+        self._recording = None
+        self._drop_cache_surface()
+        return True
 
     def stroke(self, color=None, alpha=1):
         if color or alpha < 1:
@@ -283,8 +444,7 @@ class Graphics(object):
         if y is not None:
             self._add_instruction("line_to", x, y)
         elif isinstance(x, list) and y is None:
-            for x2, y2 in x:
-                self._add_instruction("line_to", x2, y2)
+            self._add_instruction("lines_to", _packed(x))
 
 
     def rel_line_to(self, x, y = None):
@@ -301,6 +461,74 @@ class Graphics(object):
     def close_path(self):
         self._add_instruction("close_path")
 
+    def polyline(self, points, close_path = False):
+        """draw a line through all the given points in a single instruction.
+        points is a flat, packed sequence of coordinates (x1, y1, x2, y2, ...)
+        in array.array, memoryview or numpy array - or simply a list of numbers
+        or (x, y) tuples"""
+        self._add_instruction("polyline", _packed(points), close_path)
+
+    def polygon(self, points):
+        """same as :func:`polyline`, except that the path gets closed"""
+        self._add_instruction("polyline", _packed(points), True)
+
+    def rectangles(self, rectangles):
+        """draw many rectangles in a single instruction. rectangles is a
+        packed sequence of (x, y, width, height) quads. See :func:`polyline`
+        for accepted types"""
+        self._add_instruction("rectangles", _packed(rectangles))
+
+    def circles(self, circles):
+        """draw many circles in a single instruction. circles is a packed
+        sequence of (x, y, radius) triplets. See :func:`polyline` for
+        accepted types"""
+        self._add_instruction("circles", _packed(circles))
+
+    def points(self, points, size = 1):
+        """draw a size x size square at each of the given points (packed
+        x, y sequence), in a single instruction. Fill to make them show"""
+        self._add_instruction("points", _packed(points), size)
+
+    # bulk instructions are executed in a tight loop by _<instruction name>
+    _bulk_instructions = ("lines_to", "polyline", "rectangles", "circles", "points")
+
+    # instructions that only paint, leaving the path, the matrix and the clip
+    # as they are
+    _paintless_instructions = ("set_color", "set_dash", "set_line_width", "set_source",
+                               "set_source_pixbuf", "set_source_surface", "show_layout",
+                               "show_text", "paint", "mask", "fill_preserve",
+                               "stroke_preserve")
+
+    def _lines_to(self, context, coords):
+        line_to, coords = context.line_to, iter(coords)
+        for x, y in zip(coords, coords):
+            line_to(x, y)
+
+    def _polyline(self, context, coords, close_path):
+        if len(coords) < 2:
+            return
+        context.move_to(coords[0], coords[1])
+        self._lines_to(context, coords[2:])
+        if close_path:
+            context.close_path()
+
+    def _rectangles(self, context, coords):
+        rectangle, coords = context.rectangle, iter(coords)
+        for x, y, w, h in zip(coords, coords, coords, coords):
+            rectangle(x, y, w, h)
+
+    def _circles(self, context, coords):
+        move_to, arc, coords = context.move_to, context.arc, iter(coords)
+        full_circle = math.pi * 2
+        for x, y, radius in zip(coords, coords, coords):
+            move_to(x + radius, y)
+            arc(x, y, radius, 0, full_circle)
+
+    def _points(self, context, coords, size):
+        rectangle, coords = context.rectangle, iter(coords)
+        for x, y in zip(coords, coords):
+            rectangle(x, y, size, size)
+
     def set_line_style(self, width = None, dash = None, dash_offset = 0):
         """change width and dash of a line"""
         if width is not None:
@@ -504,25 +732,89 @@ class Graphics(object):
                 self._set_color(self.context, *params)
             elif function == "show_layout":
                 self._show_layout(self.context, *params)
+            elif function in self._bulk_instructions:
+                getattr(self, "_" + function)(self.context, *params)
             else:
                 getattr(self.context, function)(*params)
         else:
-            self.paths = None
+            if self.__new_instructions is None:
+                self.__new_instructions = []
             self.__new_instructions.append((function, params))
 
 
-    def _draw(self, context, opacity):
-        """draw accumulated instructions in context"""
+    def _capture_paths(self):
+        """makes sure paths for mouse hit checks and extents are there,
+        replaying the instructions on a scratch context if they have not
+        been captured while drawing. returns the paths"""
+        if self._take_new_instructions() or self.paths is None:
+            self._draw(cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 0, 0)), 1)
+        return self.paths
+
+    def _has_clip(self):
+        """true if there is a clip among the instructions"""
+        self._take_new_instructions()
+        return any(instruction == "clip" for instruction, args in self.__instruction_cache)
+
+    def _get_ink_extents(self):
+        """(x1, y1, x2, y2) box around what the instructions draw, strokes
+        and text included, in the coordinates of the graphics. None when
+        nothing gets drawn, False when it can't be told because something is
+        painted without a clip. measured once per version of the instructions
+        by replaying them on a recording surface, without capturing paths.
+        Graphics that are different every time we ask are not measured at
+        all, as that would cost as much as drawing them once more"""
+        self._take_new_instructions()
+        cached = self._ink_extents
+        if cached is not None:
+            version, extents, measured = cached
+            if version == self._version:
+                self._ink_changes = 0
+                if measured:
+                    return extents
+            else:
+                self._ink_changes += 1
+                if self._ink_changes > 2:
+                    self._ink_extents = (self._version, False, False)
+                    return False
 
-        # if we have been moved around, we should update bounds
-        fresh_draw = len(self.__new_instructions or []) > 0
-        if fresh_draw: #new stuff!
+        # paint and mask cover whatever the clip is, if there is one
+        clipped, saved, extents = False, [], None
+        for instruction, args in self.__instruction_cache:
+            if instruction == "save":
+                saved.append(clipped)
+            elif instruction == "restore":
+                clipped = saved.pop() if saved else clipped
+            elif instruction == "clip":
+                clipped = True
+            elif instruction in ("paint", "mask") and not clipped:
+                extents = False
+                break
+
+        if extents is None and self.__instruction_cache:
+            recording = self._recording
+            if recording is None:
+                recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+                self._draw(cairo.Context(recording), 1, False)
+            x, y, width, height = recording.ink_extents()
+            if width or height:
+                extents = (x, y, x + width, y + height)
+
+        self._ink_extents = (self._version, extents, True)
+        return extents
+
+    def _draw(self, context, opacity, capture_paths = True):
+        """draw accumulated instructions in context. paths are captured
+        along the way unless told not to - then they stay None until
+        :func:`_capture_paths` is called"""
+
+        # capture paths when there is new stuff, or they have not been captured yet
+        self._take_new_instructions()
+        fresh_draw = capture_paths and self.paths is None
+        if fresh_draw:
             self.paths = []
-            self.__instruction_cache = self.__new_instructions
-            self.__new_instructions = []
-        else:
-            if not self.__instruction_cache:
-                return
+
+        if not self.__instruction_cache:
+            return
 
         for instruction, args in self.__instruction_cache:
             if fresh_draw:
@@ -536,6 +828,8 @@ class Graphics(object):
                 self._set_color(context, args[0], args[1], args[2], args[3] * opacity)
             elif instruction == "show_layout":
                 self._show_layout(context, *args)
+            elif instruction in self._bulk_instructions:
+                getattr(self, "_" + instruction)(context, *args)
             elif opacity < 1 and instruction == "paint":
                 context.paint_with_alpha(opacity)
             else:
@@ -543,16 +837,163 @@ class Graphics(object):
 
 
 
-    def _draw_as_bitmap(self, context, opacity):
+    def _draw_compiled(self, context, opacity):
+        """
+            records the instructions on a cairo.RecordingSurface once and then
+            replays the whole recording with a single paint. as opposed to the
+            bitmap cache, the recording stays resolution-independent, so the
+            sprite keeps full quality when scaled or rotated.
+            use compile_graphics on sprite to enable this mode
+        """
+        self._take_new_instructions()
+        if self._recording is None:
+            # recorded fully opaque, so that opacity changes don't have us
+            # record again
+            recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            self._draw(cairo.Context(recording), 1)
+            self._recording = recording
+
+        if not self.__instruction_cache:
+            return
+
+        context.set_source_surface(self._recording)
+        if opacity < 1:
+            context.paint_with_alpha(opacity)
+        else:
+            context.paint()
+
+        if self._has_clip():
+            # the clips in the recording stay in there, so do them again on
+            # the context, for the children to be clipped as well
+            self._replay_clip(context)
+
+    def _replay_clip(self, context):
+        """runs the path, transformation and clip instructions on the
+        context, leaving out the drawing, so that it ends up with the clip
+        and the matrix that the instructions leave behind"""
+        for instruction, args in self.__instruction_cache:
+            if instruction in self._paintless_instructions:
+                continue
+            elif instruction in ("fill", "stroke"):
+                context.new_path()
+            elif instruction in self._bulk_instructions:
+                getattr(self, "_" + instruction)(context, *args)
+            else:
+                getattr(context, instruction)(*args)
+
+
+    def _drop_cache_surface(self):
+        """forget the bitmap cache. it will be redone on next draw"""
+        if self._surface_cache:
+            self._surface_cache.discard(self)
+            self._surface_cache = None
+        self.cache_surface = None
+        self._last_matrix = None
+        self._cache_scale = None
+
+    def _get_recording_size(self):
+        """rough size of the recording in bytes. cairo won't tell, so it is
+        estimated from the instructions that went in, counting every
+        coordinate of the bulk ones"""
+        if self._recording is None:
+            return 0
+        size = 0
+        for instruction, args in self.__instruction_cache:
+            if instruction in self._bulk_instructions:
+                size += len(args[0]) * 16
+            size += 64
+        return size
+
+
+    def _draw_as_transformed_bitmap(self, context, opacity, surface_cache = None,
+                                    raster_scale = None, tolerance = 1):
+        """
+            bitmap cache that survives rotation and scaling. the drawing is
+            rasterized in the sprite's own coordinates and the resulting
+            surface is then painted through the current matrix, so moving,
+            rotating and scaling the sprite costs a single filtered paint.
+            the raster is redone only on new instructions, or when the scale
+            drifts out of the quality range - see
+            :attr:`Sprite.bitmap_scale`.
+            use cache_as_bitmap="transform" on sprite to enable this mode
+        """
+        xx, yx, xy, yy, x0, y0 = context.get_matrix()
+        scale = max(math.hypot(xx, yx), math.hypot(xy, yy), 1.0 / 64)
+
+        current = self._cache_scale
+        if raster_scale is None:
+            if current and current / (2.0 * tolerance) < scale <= current * tolerance:
+                raster_scale = current
+            else:
+                # closest power of two that is not smaller than the scale
+                raster_scale = 2 ** math.ceil(math.log(scale, 2))
+
+        self._take_new_instructions()
+        if self._recording is None:
+            # the recording keeps the vector version that we rasterize from,
+            # and as a side effect gives us fresh paths for hit checks
+            recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            self._draw(cairo.Context(recording), 1)
+            self._recording = recording
+
+        if not self.__instruction_cache:
+            self._drop_cache_surface()
+            return
+
+        if self.cache_surface is None or current != raster_scale:
+            x, y, w, h = self._recording.ink_extents()
+            if not w or not h:
+                self._drop_cache_surface()
+                return
+
+            # one pixel of padding all around so the filter has something
+            # transparent to blend the edges with
+            width = int(math.ceil(w * raster_scale)) + 2
+            height = int(math.ceil(h * raster_scale)) + 2
+            self.cache_surface = context.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA,
+                                                                     width, height)
+            self._cache_scale = raster_scale
+            self._cache_origin = (x, y)
+            if surface_cache:
+                # the recording is kept to rasterize from, so it is on the
+                # bill too
+                surface_cache.add(self, width * height * 4 + self._get_recording_size())
+
+            ctx = cairo.Context(self.cache_surface)
+            ctx.translate(1, 1)
+            ctx.scale(raster_scale, raster_scale)
+            ctx.translate(-x, -y)
+            ctx.set_source_surface(self._recording)
+            ctx.paint()
+        elif surface_cache:
+            surface_cache.hit(self)
+
+        x, y = self._cache_origin
+        context.save()
+        context.translate(x, y)
+        context.scale(1.0 / raster_scale, 1.0 / raster_scale)
+        context.set_source_surface(self.cache_surface, -1, -1)
+        context.get_source().set_filter(cairo.FILTER_GOOD)
+        if opacity < 1:
+            context.paint_with_alpha(opacity)
+        else:
+            context.paint()
+        context.restore()
+
+    def _draw_as_bitmap(self, context, opacity, surface_cache = None):
         """
             instead of caching paths, this function caches the whole drawn thing
-            use cache_as_bitmap on sprite to enable this mode
+            use cache_as_bitmap on sprite to enable this mode.
+            if surface_cache (:class:`SurfaceCache`) is given, the cache surface
+            is accounted for there and might get dropped to keep within budget
         """
         matrix = context.get_matrix()
+        new_instructions = self._take_new_instructions()
         matrix_changed = matrix != self._last_matrix
-        new_instructions = self.__new_instructions is not None and len(self.__new_instructions) > 0
 
-        if not new_instructions and not matrix_changed:
+        if self.cache_surface is not None and not matrix_changed:
+            if surface_cache:
+                surface_cache.hit(self)
             context.save()
             context.identity_matrix()
             context.translate(self.extents.x, self.extents.y)
@@ -564,16 +1005,12 @@ class Graphics(object):
             context.restore()
             return
 
-
-        if new_instructions:
-            self.__instruction_cache = list(self.__new_instructions)
-            self.__new_instructions = deque()
-
         self.paths = []
         self.extents = None
 
         if not self.__instruction_cache:
             # no instructions - nothing to do
+            self._drop_cache_surface()
             return
 
         # instructions that end path
@@ -610,6 +1047,8 @@ class Graphics(object):
                 self._set_color(context, args[0], args[1], args[2], args[3] * opacity)
             elif instruction == "show_layout":
                 self._show_layout(context, *args)
+            elif instruction in self._bulk_instructions:
+                getattr(self, "_" + instruction)(context, *args)
             else:
                 getattr(context, instruction)(*args)
 
@@ -624,11 +1063,13 @@ class Graphics(object):
         extents.y += matrix[5] - 5
         self.extents = extents
 
-        if not just_transforms:
+        if not just_transforms or self.cache_surface is None:
             # now draw the instructions on the caching surface
             w = int(extents.width) + 10
             h = int(extents.height) + 10
             self.cache_surface = context.get_target().create_similar(cairo.CONTENT_COLOR_ALPHA, w, h)
+            if surface_cache:
+                surface_cache.add(self, w * h * 4)
             ctx = cairo.Context(self.cache_surface)
             ctx.translate(-extents.x, -extents.y)
 
@@ -638,12 +1079,553 @@ class Graphics(object):
                     self._set_color(ctx, args[0], args[1], args[2], args[3])
                 elif instruction == "show_layout":
                     self._show_layout(ctx, *args)
+                elif instruction in self._bulk_instructions:
+                    getattr(self, "_" + instruction)(ctx, *args)
                 else:
                     getattr(ctx, instruction)(*args)
 
+        elif surface_cache:
+            surface_cache.hit(self)
+
         self._last_matrix = matrix
 
 
+class SurfaceCache(object):
+    """Keeps track of the surfaces of bitmap-cached sprites (see
+    :attr:`Sprite.cache_as_bitmap`) and keeps their total size within the
+    memory budget by dropping the ones that have been drawn least recently.
+    Dropped caches are transparently re-rasterized on the sprite's next draw.
+    Each scene has one in :attr:`Scene.bitmap_cache`.
+    """
+    def __init__(self, budget = 64 * 1024 * 1024, max_idle_frames = None):
+        #: maximum total size of the cached surfaces, in bytes
+        self.budget = budget
+
+        #: drop caches of sprites that have not been drawn for this many
+        #: frames - for example, when they are hidden or out of view.
+        #: If None, caches are dropped only when running out of budget.
+        self.max_idle_frames = max_idle_frames
+
+        #: current total size of the cached surfaces, in bytes
+        self.size = 0
+
+        #: number of times a cached surface was reused
+        self.hits = 0
+
+        #: number of times a surface had to be rasterized
+        self.misses = 0
+
+        #: number of surfaces dropped to fit in the budget, for being idle or
+        #: for having been taken off the scene
+        self.evictions = 0
+
+        self._frame = 0
+        # weakref to graphics -> [bytes, last frame drawn], least recent first.
+        # the refs are weak so that graphics that are gone take their
+        # entries with them
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit(self, graphics):
+        """mark the cache surface of the graphics as just used"""
+        self.hits += 1
+        key = weakref.ref(graphics)
+        entry = self._entries.get(key)
+        if entry:
+            entry[1] = self._frame
+            self._entries.move_to_end(key)
+
+    def add(self, graphics, size):
+        """account for a freshly rasterized cache surface of the graphics"""
+        self.misses += 1
+        self.discard(graphics)
+        self._entries[weakref.ref(graphics, self._forget)] = [size, self._frame]
+        self.size += size
+        graphics._surface_cache = self
+
+        # the surface just added stays, even if it does not fit on its own
+        while self.size > self.budget and len(self._entries) > 1:
+            self._evict(next(iter(self._entries))())
+
+    def discard(self, graphics):
+        """stop tracking the surface of the graphics without dropping it"""
+        entry = self._entries.pop(weakref.ref(graphics), None)
+        if entry:
+            self.size -= entry[0]
+
+    def drop_sprite(self, sprite):
+        """drop the cached surfaces of the sprite and all of its children.
+        the scene calls this for the sprites it loses, so that their
+        surfaces don't linger around until pushed out of the budget"""
+        for sprite in [sprite] + list(sprite.all_child_sprites()):
+            levels = getattr(sprite, "__dict__", {}).get('_lod_graphics') or {}
+            for graphics in [sprite.graphics] + list(levels.values()):
+                if weakref.ref(graphics) in self._entries:
+                    self._evict(graphics)
+
+    def next_frame(self):
+        """advance the frame counter and drop idle surfaces. scene calls this
+        after every frame"""
+        self._frame += 1
+        if self.max_idle_frames is None:
+            return
+
+        for key, (size, last_frame) in list(self._entries.items()):
+            if self._frame - last_frame <= self.max_idle_frames:
+                break # the rest have been drawn more recently
+            self._evict(key())
+
+    def clear(self):
+        """drop all cached surfaces"""
+        for key in list(self._entries):
+            self._evict(key())
+
+    def get_stats(self):
+        """returns dict with the cache counters"""
+        return {"surfaces": len(self._entries), "size": self.size,
+                "budget": self.budget, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def _evict(self, graphics):
+        self.discard(graphics)
+        graphics._drop_cache_surface()
+        graphics._recording = None # counted along with the surface
+        self.evictions += 1
+
+    def _forget(self, key):
+        # the graphics of the entry are gone
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[0]
+
+
+class SpatialIndex(object):
+    """Uniform grid of the scene-space extents of interactive sprites, so
+    that finding the sprite under the mouse means checking the few sprites
+    in the grid cell instead of all of them. Sprites mark themselves stale
+    when they move or their graphics change, and the stale ones are
+    measured again on the next lookup. Each scene has one.
+    """
+    def __init__(self, scene, cell_size = 64):
+        self.scene = scene
+
+        #: size of the grid cell, in pixels
+        self.cell_size = cell_size
+
+        #: bumped on every change that might affect what is under the mouse
+        self.generation = 0
+
+        self._cells = defaultdict(set) # (column, row) -> sprites
+        self._cell_generations = {} # (column, row) -> bumped when sprites in it change
+        self._extents = {} # sprite -> (extents, cells)
+        self._stale = set()
+
+    def __len__(self):
+        self.update()
+        return len(self._extents)
+
+    def invalidate(self, sprite, subtree = False):
+        """mark the sprite, and all of its children if `subtree` is set, to
+        be measured again"""
+        self.generation += 1
+        self._stale.add(sprite)
+        if subtree and sprite.sprites:
+            for child in sprite.all_child_sprites():
+                self._stale.add(child)
+
+    def remove(self, sprite):
+        """drop the sprite along with all of its children from the index"""
+        self.generation += 1
+        for sprite in [sprite] + list(sprite.all_child_sprites()):
+            self._stale.discard(sprite)
+            self._drop(sprite)
+
+    def update(self):
+        """measure the stale sprites and put them in the right cells"""
+        while self._stale:
+            sprite = self._stale.pop()
+            self._drop(sprite)
+            if not sprite.interactive or not self._reachable(sprite):
+                continue
+
+            extents = sprite.get_extents()
+            self._stale.discard(sprite) # fresh, even if it invalidated itself
+            if not extents:
+                continue
+
+            cells = self.get_cells(extents.x, extents.y, extents.width, extents.height)
+            for cell in cells:
+                self._cells[cell].add(sprite)
+            self._touch(cells)
+            self._extents[sprite] = (extents, cells)
+
+    def get_cells(self, x, y, width, height):
+        """returns list of the cells that the scene-space rectangle touches"""
+        size = float(self.cell_size)
+        return [(col, row)
+                for col in range(int(math.floor(x / size)), int(math.floor((x + width) / size)) + 1)
+                for row in range(int(math.floor(y / size)), int(math.floor((y + height) / size)) + 1)]
+
+    def get_generations(self, cells):
+        """returns tuple of the change counters of the given cells. a counter
+        goes up whenever a sprite comes to, leaves, or changes in its cell,
+        so as long as they stay the same, the cells have the same sprites
+        in the same order and places"""
+        self.update()
+        generations = self._cell_generations
+        return tuple(generations.get(cell, 0) for cell in cells)
+
+    def at(self, x, y):
+        """returns list of the sprites that have the scene-space point
+        within their extents"""
+        self.update()
+        cell = self._cells.get((int(math.floor(x / float(self.cell_size))),
+                                int(math.floor(y / float(self.cell_size)))))
+        if not cell:
+            return []
+
+        res = []
+        for sprite in cell:
+            extents = self._extents[sprite][0]
+            if extents.x <= x <= extents.x + extents.width and \
+               extents.y <= y <= extents.y + extents.height:
+                res.append(sprite)
+        return res
+
+    def in_rect(self, x, y, width, height):
+        """returns list of the sprites with extents that touch the scene-space
+        rectangle"""
+        self.update()
+        size = float(self.cell_size)
+        cols = range(int(math.floor(x / size)), int(math.floor((x + width) / size)) + 1)
+        rows = range(int(math.floor(y / size)), int(math.floor((y + height) / size)) + 1)
+
+        if len(cols) * len(rows) > len(self._cells):
+            # more cells in the rectangle than there are filled ones
+            candidates = self._extents
+        else:
+            candidates = set()
+            for col in cols:
+                for row in rows:
+                    candidates.update(self._cells.get((col, row), ()))
+
+        found = []
+        for sprite in candidates:
+            extents = self._extents[sprite][0]
+            if extents.x <= x + width and x <= extents.x + extents.width and \
+               extents.y <= y + height and y <= extents.y + extents.height:
+                found.append(sprite)
+        return found
+
+    def near(self, x, y, radius):
+        """returns list of (distance, sprite) of the sprites with extents
+        within the radius from the scene-space point"""
+        found = []
+        for sprite in self.in_rect(x - radius, y - radius, radius * 2, radius * 2):
+            distance = _rectangle_distance(self._extents[sprite][0], x, y)
+            if distance <= radius:
+                found.append((distance, sprite))
+        return found
+
+    def nearest(self, x, y, count = 1, max_distance = None):
+        """returns list of (distance, sprite) of the `count` sprites with
+        extents closest to the scene-space point, closest first"""
+        self.update()
+        radius = float(self.cell_size)
+        while True:
+            if max_distance is not None:
+                radius = min(radius, max_distance)
+
+            found = self.near(x, y, radius)
+            if len(found) >= count or len(found) == len(self._extents) or radius == max_distance:
+                break
+            radius *= 2
+
+        found.sort(key=lambda item: item[0])
+        return found[:count]
+
+    def _drop(self, sprite):
+        extents, cells = self._extents.pop(sprite, (None, ()))
+        for cell in cells:
+            sprites = self._cells[cell]
+            sprites.discard(sprite)
+            if not sprites:
+                del self._cells[cell]
+        self._touch(cells)
+
+    def _touch(self, cells):
+        generations = self._cell_generations
+        for cell in cells:
+            generations[cell] = generations.get(cell, 0) + 1
+
+    def _reachable(self, sprite):
+        """true if the sprite and all its parents are visible and the scene
+        is at the top"""
+        while isinstance(sprite, Sprite):
+            if not sprite.visible:
+                return False
+            sprite = sprite.parent
+        return sprite is self.scene
+
+
+class PickBuffer(object):
+    """Offscreen buffer where each visible interactive sprite is filled with
+    its own flat color, so that finding the sprite under the mouse is a
+    matter of reading a pixel. The buffer is kept in the cells of the
+    scene's :class:`SpatialIndex`, and only the cells that have changed
+    since they were drawn get redrawn, once they are looked up. Used by the
+    scene when :attr:`Scene.pick_buffer` is on.
+    """
+    def __init__(self, scene):
+        self.scene = scene
+        self._surface = None
+        self._pixels = None
+        self._sprites = [None] # color -> sprite, 0 is the background
+        self._colors = {} # sprite -> color
+        self._drawn = {} # cell -> its generation when drawn
+
+    def invalidate(self):
+        """redraw the buffer on the next lookup"""
+        self._surface = None
+
+    def sprite_at(self, x, y, exact = False):
+        """returns the topmost interactive sprite at the scene-space point.
+        As the buffer is drawn without antialiasing, it can be a pixel off on
+        the sprite edges. With `exact` set, points next to an edge are
+        checked against the sprite paths instead"""
+        width, height = self.scene.from_scene_coords(self.scene.width, self.scene.height)
+        width, height = int(math.ceil(width)), int(math.ceil(height))
+
+        index = self.scene._spatial_index
+        index.update()
+        if self._surface is None or \
+           (self._surface.get_width(), self._surface.get_height()) != (width, height) or \
+           len(self._sprites) > len(index._extents) * 2 + 1024:
+            # start over on resize, as well as when most of the colors belong
+            # to sprites that are gone
+            self._reset(width, height)
+
+        px, py = int(math.floor(x)), int(math.floor(y))
+        if exact:
+            cells = index.get_cells(px - 1, py - 1, 2, 2)
+        else:
+            cells = index.get_cells(px, py, 0, 0)
+        for cell in cells:
+            self._draw_cell(cell)
+
+        color = self._get_color(px, py)
+
+        if exact:
+            colors = set(self._get_color(px + dx, py + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+            if len(colors) > 1:
+                # on an edge - check the topmost first
+                sprites = [self._sprites[color] for color in colors if color]
+                for sprite in sorted(sprites, key=self.scene._get_mouse_path, reverse=True):
+                    if sprite.check_hit(x, y):
+                        return sprite
+                return None
+
+        return self._sprites[color]
+
+    def _reset(self, width, height):
+        self._surface = cairo.ImageSurface(cairo.FORMAT_RGB24, max(width, 1), max(height, 1))
+        self._pixels = memoryview(self._surface.get_data()).cast("I")
+        self._sprites, self._colors, self._drawn = [None], {}, {}
+
+    def _get_color(self, x, y):
+        width, height = self._surface.get_width(), self._surface.get_height()
+        if not (0 <= x < width and 0 <= y < height):
+            return 0
+        color = self._pixels[y * self._surface.get_stride() // 4 + x] & 0xffffff
+        return color if color < len(self._sprites) else 0
+
+    def _draw_cell(self, cell):
+        """redraw the cell if the sprites in it have changed since"""
+        index = self.scene._spatial_index
+        generation = index._cell_generations.get(cell, 0)
+        if self._drawn.get(cell) == generation:
+            return
+        self._drawn[cell] = generation
+
+        context = cairo.Context(self._surface)
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        size = index.cell_size
+        context.rectangle(cell[0] * size, cell[1] * size, size, size)
+        context.clip()
+        context.set_source_rgb(0, 0, 0)
+        context.paint()
+
+        # the ones the mouse would get to later are on top
+        paths = dict((sprite, self.scene._get_mouse_path(sprite))
+                     for sprite in index._cells.get(cell, ()))
+        sprites = sorted((sprite for sprite, path in paths.items() if path is not None),
+                         key=paths.get)
+
+        for sprite in sprites:
+            extents = sprite.get_extents()
+            if not extents:
+                continue
+
+            color = self._colors.get(sprite)
+            if color is None:
+                color = self._colors[sprite] = len(self._sprites)
+                self._sprites.append(sprite)
+
+            # same area that check_hit goes by - the paths within the extents,
+            # and within the clips of the parents
+            context.save()
+            context.rectangle(extents.x, extents.y, extents.width + 1, extents.height + 1)
+            context.clip()
+            self._clip_to_parents(context, sprite)
+            context.set_matrix(sprite._get_world_matrix())
+            for instruction, type, path in sprite.graphics._capture_paths():
+                if type == "path":
+                    context.append_path(path)
+                else:
+                    getattr(context, instruction)(*path)
+            context.set_source_rgb(((color >> 16) & 255) / 255.0,
+                                   ((color >> 8) & 255) / 255.0,
+                                   (color & 255) / 255.0)
+            context.fill()
+            context.restore()
+
+        self._surface.flush()
+
+    def _clip_to_parents(self, context, sprite):
+        """apply the clips the parents of the sprite leave in effect"""
+        for parent in sprite.get_parents():
+            if not parent.graphics._has_clip():
+                continue
+
+            clips = []
+            for instruction, type, path in parent.graphics._capture_paths():
+                if instruction == "clip":
+                    clips.append(path)
+                elif instruction == "restore" and clips:
+                    clips.pop()
+
+            context.set_matrix(parent._get_world_matrix())
+            for path in clips:
+                context.new_path()
+                context.append_path(path)
+                context.clip()
+        context.new_path()
+
+
+class FrameProfiler(object):
+    """Records where the time of each frame goes - per-phase timings and
+    how many times each sprite was rendered and drawn. The phases are
+    `enter-frame` (on-enter-frame handlers), `tweens` (tweener update),
+    `render` (on-render handlers), `draw` (replaying the sprite graphics),
+    `extents` (:func:`Sprite.get_extents`) and `mouse` (hit checks).
+    Phases can nest - extents are often measured during render - so the
+    phase times do not necessarily add up to the frame time.
+    Everything that happens between two frames counts towards the latter.
+    Start with :func:`Scene.start_profiling`.
+    """
+    def __init__(self, frames = 300):
+        #: ring buffer with the last `frames` frames, oldest first. Each
+        #: frame is a dict with `frame` number, `start` and `duration` in
+        #: seconds, `phases` and `calls` dicts keyed by phase, `sprites`
+        #: dict of sprite label -> {"render": count, "draw": count} and
+        #: `events` list of (phase, start, duration, sprite label) tuples
+        self.frames = deque(maxlen = frames)
+
+        self._frame = None
+        self._frame_number = 0
+
+    def add(self, phase, started, sprite = None):
+        """record the phase that began at `started` (:func:`time.perf_counter`
+        value) and finished just now. the sprite, if given, gets the
+        render or draw counted"""
+        now = time.perf_counter()
+        frame = self._frame or self.begin_frame(started)
+
+        frame["phases"][phase] += now - started
+        frame["calls"][phase] += 1
+
+        label = None
+        if sprite is not None:
+            label = sprite.id or "%s@%x" % (sprite.__class__.__name__, id(sprite))
+            if phase in ("render", "draw"):
+                frame["sprites"][label][phase] += 1
+
+        frame["events"].append((phase, started, now - started, label))
+
+    def begin_frame(self, started = None):
+        """start recording a new frame unless one is being recorded already"""
+        if self._frame is None:
+            self._frame = {"frame": self._frame_number,
+                           "start": started or time.perf_counter(),
+                           "duration": None,
+                           "phases": defaultdict(float),
+                           "calls": defaultdict(int),
+                           "sprites": defaultdict(lambda: {"render": 0, "draw": 0}),
+                           "events": []}
+        return self._frame
+
+    def end_frame(self):
+        """finish the frame and put it in the ring buffer"""
+        frame = self._frame or self.begin_frame()
+        frame["duration"] = time.perf_counter() - frame["start"]
+        self.frames.append(frame)
+        self._frame = None
+        self._frame_number += 1
+
+    def clear(self):
+        """forget all recorded frames"""
+        self.frames.clear()
+        self._frame = None
+
+    def get_summary(self):
+        """returns dict of phase -> average seconds per frame over the
+        recorded frames, plus the average `frame` duration"""
+        if not self.frames:
+            return {}
+
+        totals = defaultdict(float)
+        for frame in self.frames:
+            totals["frame"] += frame["duration"]
+            for phase, duration in frame["phases"].items():
+                totals[phase] += duration
+
+        return dict((phase, total / len(self.frames)) for phase, total in totals.items())
+
+    def to_json(self):
+        """returns the recorded frames as JSON, leaving out the events"""
+        frames = []
+        for frame in self.frames:
+            frame = dict((key, value) for key, value in frame.items() if key != "events")
+            frame["sprites"] = dict(frame["sprites"])
+            frames.append(frame)
+        return json.dumps({"frames": frames}, indent=1)
+
+    def to_chrome_trace(self):
+        """returns the recorded frames as JSON in the Trace Event Format,
+        suitable for loading in chrome://tracing"""
+        events = []
+        for frame in self.frames:
+            events.append({"name": "frame %d" % frame["frame"], "cat": "frame", "ph": "X",
+                           "ts": frame["start"] * 1000000, "dur": frame["duration"] * 1000000,
+                           "pid": 0, "tid": 0})
+            for phase, started, duration, label in frame["events"]:
+                event = {"name": phase, "cat": phase, "ph": "X",
+                         "ts": started * 1000000, "dur": duration * 1000000,
+                         "pid": 0, "tid": 0}
+                if label:
+                    event["args"] = {"sprite": label}
+                events.append(event)
+        return json.dumps({"traceEvents": events})
+
+    def dump(self, filename, chrome_trace = False):
+        """write the recorded frames to the file, as plain JSON or as
+        chrome trace"""
+        with open(filename, "w") as f:
+            f.write(self.to_chrome_trace() if chrome_trace else self.to_json())
+
+
 class Parent(object):
     """shared functions across scene and sprite"""
 
@@ -700,37 +1682,141 @@ class Parent(object):
             self.sprites.append(sprite)
         sprite.parent = self
 
+        scene = self.get_scene()
+        if scene:
+            scene._spatial_index.invalidate(sprite, True)
+
 
     def _sort(self):
-        """sort sprites by z_order"""
-        self.__dict__['_z_ordered_sprites'] = sorted(self.sprites, key=lambda sprite:sprite.z_order)
+        """sort sprites by z_order. sprites with the same z_order are kept in
+        the order they are in the sprites list"""
+        scene = self.get_scene()
+        if scene is not None and scene._batch_depth:
+            scene._batch_sorts.add(self) # sorted once the batch is over
+            return
+
+        # the sequence number keeps the order stable when we later bisect
+        key_of = dict((sprite, (sprite.z_order, i)) for i, sprite in enumerate(self.sprites))
+        self.__dict__['_z_key_of'] = key_of
+        self.__dict__['_z_counter'] = len(self.sprites)
+
+        ordered = sorted(self.sprites, key=key_of.get)
+        self.__dict__['_z_ordered_sprites'] = ordered
+        self.__dict__['_z_keys'] = [key_of[sprite] for sprite in ordered]
+
+    def _z_insert(self, sprites):
+        """put freshly appended sprites in their z_order place. a single
+        sprite is bisected in, several are merged in one go"""
+        counter = self.__dict__.get('_z_counter', 0)
+        added = []
+        for sprite in sprites:
+            key = self._z_key_of[sprite] = (sprite.z_order, counter)
+            added.append((key, sprite))
+            counter += 1
+        self.__dict__['_z_counter'] = counter
+
+        keys, ordered = self._z_keys, self._z_ordered_sprites
+        if len(added) == 1:
+            key, sprite = added[0]
+            i = bisect.bisect(keys, key)
+            keys.insert(i, key)
+            ordered.insert(i, sprite)
+        elif added:
+            added.sort(key=lambda item: item[0])
+            merged = list(heapq.merge(zip(keys, ordered), added))
+            self.__dict__['_z_keys'] = [key for key, sprite in merged]
+            self.__dict__['_z_ordered_sprites'] = [sprite for key, sprite in merged]
+
+    def _z_remove(self, sprite):
+        """take the sprite out of the z-ordered list. returns False if the
+        sprite was not where expected and the list needs a full sort"""
+        key = self._z_key_of.pop(sprite, None)
+        keys, ordered = self._z_keys, self._z_ordered_sprites
+        if key is None:
+            return False
+
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key and ordered[i] is sprite:
+            del keys[i]
+            del ordered[i]
+            return True
+        return False
+
+    def _z_move(self, sprite):
+        """move the child into its place after a z_order change"""
+        key = self._z_key_of.get(sprite)
+        if not self._z_remove(sprite):
+            self._sort()
+            return
+
+        key = self._z_key_of[sprite] = (sprite.z_order, key[1])
+        i = bisect.bisect(self._z_keys, key)
+        self._z_keys.insert(i, key)
+        self._z_ordered_sprites.insert(i, sprite)
 
     def add_child(self, *sprites):
         """Add child sprite. Child will be nested within parent"""
+        # sprites that are here already get moved to the end, easier to
+        # sort the whole thing then
+        resort = len(set(sprites)) != len(sprites) or \
+                 any(getattr(sprite, "parent", None) is self for sprite in sprites)
+
         for sprite in sprites:
             self._add(sprite)
-        self._sort()
+
+        if resort:
+            self._sort()
+        else:
+            self._z_insert(sprites)
         self.redraw()
 
     def remove_child(self, *sprites):
         """Remove one or several :class:`Sprite` sprites from scene """
-
-        # first drop focus
         scene = self.get_scene()
-
-        if scene:
-            child_sprites = list(self.all_child_sprites())
-            if scene._focus_sprite in child_sprites:
+        removed = [sprite for sprite in sprites if getattr(sprite, "parent", None) is self]
+        removed_set = set(removed)
+
+        # first drop focus if it is within what we are removing - walk up
+        # from the focused sprite rather than down all our children
+        focus = scene._focus_sprite if scene else None
+        while focus is not None and focus is not self:
+            if focus in removed_set:
                 scene._focus_sprite = None
-
-
+                break
+            focus = getattr(focus, "parent", None)
+
+
+        for sprite in removed:
+            if scene:
+                scene._redraw_sprite(sprite) # repaint the area we are leaving
+                scene._spatial_index.remove(sprite)
+                if len(scene.bitmap_cache):
+                    scene.bitmap_cache.drop_sprite(sprite)
+            sprite._scene = None
+            sprite.parent = None
+
+        # taking out several sprites in a single pass over the lists
+        resort = False
+        if len(removed) == 1:
+            self.sprites.remove(removed[0])
+            resort = not self._z_remove(removed[0])
+        elif removed:
+            self.sprites[:] = [sprite for sprite in self.sprites if sprite not in removed_set]
+            for sprite in removed:
+                self._z_key_of.pop(sprite, None)
+            ordered = [(key, sprite) for key, sprite in zip(self._z_keys, self._z_ordered_sprites)
+                       if sprite not in removed_set]
+            self.__dict__['_z_keys'] = [key for key, sprite in ordered]
+            self.__dict__['_z_ordered_sprites'] = [sprite for key, sprite in ordered]
+
+        handlers = self._child_handlers
         for sprite in sprites:
-            if sprite in self.sprites:
-                self.sprites.remove(sprite)
-                sprite._scene = None
-                sprite.parent = None
-            self.disconnect_child(sprite)
-        self._sort()
+            for handler in handlers.pop(sprite, ()):
+                if sprite.handler_is_connected(handler):
+                    sprite.disconnect(handler)
+
+        if resort:
+            self._sort()
         self.redraw()
 
 
@@ -739,6 +1825,74 @@ class Parent(object):
         self.remove_child(*self.sprites)
 
 
+    def reconcile(self, keys, factory, update = None):
+        """Make the keyed children match the given list of keys, reusing the
+        sprites of the keys that were there the last time. Sprites for new
+        keys come from `factory(key)`, or, if `factory` is a
+        :class:`SpritePool`, out of the pool. Sprites of the keys that are
+        gone are removed, and released back into the pool if there is one.
+        `update(sprite, key)` is called for every sprite, new and old.
+        Keyed children follow the order of the keys, other children stay
+        where they are. Returns the sprites in the order of the keys.
+        Keep the pool around between the calls, for the sprites to be reused.
+        Example::
+
+            class FactList(graphics.Sprite):
+                def __init__(self):
+                    graphics.Sprite.__init__(self)
+                    self.pool = graphics.SpritePool(FactSprite)
+
+                def show_facts(self, facts):
+                    self.reconcile(facts, self.pool, self.render_fact)
+
+                def render_fact(self, sprite, fact):
+                    sprite.x, sprite.y = fact.x, fact.y
+        """
+        keys = list(keys)
+        if len(set(keys)) != len(keys):
+            raise Exception("reconcile needs unique keys")
+
+        scene = self.get_scene()
+        if scene is not None and not scene._batch_depth:
+            with scene.batch():
+                return self.reconcile(keys, factory, update)
+
+        pool = factory if isinstance(factory, SpritePool) else None
+
+        # reuse what is still ours, drop the rest
+        previous, keyed = self.__dict__.get('_keyed_children') or {}, {}
+        for key in keys:
+            sprite = previous.pop(key, None)
+            if sprite is not None and sprite.parent is self:
+                keyed[key] = sprite
+        stale = [sprite for sprite in previous.values() if sprite.parent is self]
+        if pool is not None:
+            pool.release(*stale)
+        elif stale:
+            self.remove_child(*stale)
+
+        sprites = []
+        for key in keys:
+            sprite = keyed.get(key)
+            if sprite is None:
+                sprite = keyed[key] = pool.acquire() if pool is not None else factory(key)
+                self._add(sprite)
+            sprites.append(sprite)
+            if update:
+                update(sprite, key)
+        self.__dict__['_keyed_children'] = keyed
+
+        # the keyed slots in the child list get the sprites in key order
+        keyed_sprites = set(sprites)
+        ordered = iter(sprites)
+        self.sprites[:] = [next(ordered) if sprite in keyed_sprites else sprite
+                           for sprite in self.sprites]
+
+        self._sort()
+        self.redraw()
+        return sprites
+
+
     def destroy(self):
         """recursively removes all sprite children so that it is freed from
         any references and can be garbage collected"""
@@ -797,6 +1951,13 @@ class Parent(object):
         return "<%s %s>" % (self.__class__.__name__, getattr(self, "id", None) or str(id(self)))
 
 
+# per sprite class lookup of what setting an attribute affects, filled in
+# lazily by Sprite.__setattr__
+_attr_kinds = {}
+
+# handler ids of LightSprite callbacks
+_light_handler_ids = itertools.count(1)
+
 class Sprite(Parent, gobject.GObject):
     """The Sprite class is a basic display list building block: a display list
        node that can display graphics and can also contain children.
@@ -822,6 +1983,7 @@ class Sprite(Parent, gobject.GObject):
         "on-key-press": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         "on-key-release": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
         "on-render": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        "on-render-lod": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
     }
 
     transformation_attrs = set(('x', 'y', 'rotation', 'scale_x', 'scale_y', 'pivot_x', 'pivot_y'))
@@ -841,17 +2003,52 @@ class Sprite(Parent, gobject.GObject):
     #: whether the widget can gain focus
     can_focus = None
 
+    #: levels of detail of the sprite - a list of scales, for example
+    #: ``[0.1, 0.5, 1]``. When set, instead of "on-render" the sprite gets
+    #: "on-render-lod" with the scale of the level to draw. The level is
+    #: picked every frame going by the scale the sprite ends up on screen
+    #: at - the smallest level that is not below it, or the largest one when
+    #: zoomed in further. Each level keeps its own graphics, so switching
+    #: back and forth does not redo the drawing.
+    lod_scales = None
+
+    #: whether the sprite with its children can be skipped when entirely
+    #: outside of the visible area. The check goes by what the sprite drew
+    #: the last time; changed sprites are always drawn, so they get their
+    #: on-render. Turn off for sprites that draw outside of what they drew
+    #: before without being changed, or that need their on-render to run
+    #: every frame
+    cullable = True
+
+    #: resolution of the bitmap when ``cache_as_bitmap="transform"``.
+    #: None picks the closest power of two that is not smaller than the
+    #: current scale of the sprite on screen, and redoes the bitmap when
+    #: the sprite is scaled past it. Set to a number to always rasterize
+    #: at that scale and never redo the bitmap because of scaling
+    bitmap_scale = None
+
+    #: how far the scale can drift from the bitmap resolution before the
+    #: bitmap is redone - the sprite can be scaled up to `tolerance` times
+    #: the resolution, and down to half of it divided by the tolerance.
+    #: Raise to trade sharpness for fewer redraws in scale tweens
+    bitmap_scale_tolerance = 1.1
+
     def __init__(self, x = 0, y = 0, opacity = 1, visible = True, rotation = 0,
                  pivot_x = 0, pivot_y = 0, scale_x = 1, scale_y = 1,
                  interactive = False, draggable = False, z_order = 0,
                  mouse_cursor = None, cache_as_bitmap = False,
                  snap_to_pixel = True, debug = False, id = None,
-                 can_focus = False):
+                 can_focus = False, compile_graphics = False):
         gobject.GObject.__init__(self)
 
         # a place where to store child handlers
         self.__dict__['_child_handlers'] = defaultdict(list)
 
+        # cached scene-space matrix and its inverse, see _get_world_matrix
+        self.__dict__['_world_matrix'] = None
+        self.__dict__['_world_inverse'] = None
+        self.__dict__['_world_generation'] = self.__dict__.get('_world_generation', 0)
+
         self._scene = None
 
         self.debug = debug
@@ -862,6 +2059,8 @@ class Sprite(Parent, gobject.GObject):
         self.sprites = []
 
         self._z_ordered_sprites = []
+        self.__dict__['_z_keys'] = [] # (z_order, sequence) of the above
+        self.__dict__['_z_key_of'] = {}
 
         #: instance of :ref:`graphics` for this sprite
         self.graphics = Graphics()
@@ -911,9 +2110,20 @@ class Sprite(Parent, gobject.GObject):
         self.drag_y = 0
 
         #: Whether the sprite should be cached as a bitmap. Default: true
-        #: Generally good when you have many static sprites
+        #: Generally good when you have many static sprites.
+        #: Set to "transform" for sprites that get rotated and scaled a lot -
+        #: the sprite is then cached in its own coordinates and the bitmap
+        #: gets transformed instead of being redone. See :attr:`bitmap_scale`
         self.cache_as_bitmap = cache_as_bitmap
 
+        #: Whether the sprite graphics should be recorded once and then replayed
+        #: as a whole, instead of executing the instructions one by one on
+        #: every frame. Unlike :attr:`cache_as_bitmap`, the recording is
+        #: vector, so the sprite stays sharp when scaled or rotated.
+        #: Generally good for sprites with many drawing instructions that do
+        #: not change often. Default: false
+        self.compile_graphics = compile_graphics
+
         #: Should the sprite coordinates always rounded to full pixel. Default: true
         #: Mostly this is good for performance but in some cases that can lead
         #: to rounding errors in positioning.
@@ -943,49 +2153,67 @@ class Sprite(Parent, gobject.GObject):
 
 
     def __setattr__(self, name, val):
-        if isinstance(getattr(type(self), name, None), property) and \
-           getattr(type(self), name).fset is not None:
+        # the kind of the attribute is looked up once per class and name, so
+        # that the common writes (tweened transforms mostly) skip the
+        # property probe and the walk through the attribute sets. the
+        # invalidation that follows is still done on every write
+        kinds = _attr_kinds.get(type(self))
+        if kinds is None:
+            kinds = _attr_kinds[type(self)] = {}
+        kind = kinds.get(name)
+        if kind is None:
+            kind = kinds[name] = type(self)._get_attr_kind(name)
+
+        if kind == "property":
             getattr(type(self), name).fset(self, val)
             return
 
+        if kind == "parent_matrix":
+            # we don't keep the parent matrix anymore, but setting it to None
+            # is still the way to have the sprite and its children re-measured
+            if val is None:
+                self._invalidate_world_matrix()
+                self._invalidate_extents(True)
+            return
+
         prev = self.__dict__.get(name, "hamster_graphics_no_value_really")
         if type(prev) == type(val) and prev == val:
             return
         self.__dict__[name] = val
 
-        # prev parent matrix walks downwards
-        if name == '_prev_parent_matrix' and self.visible:
-            # downwards recursive invalidation of parent matrix
-            for sprite in self.sprites:
-                sprite._prev_parent_matrix = None
-
+        if kind == "transform":
+            # on moves invalidate our matrix, child extent cache (as that
+            # depends on our transforms) as well as our parent's child extents
+            # as we moved then go into children and invalidate the world
+            # matrix down the tree. update() does this once for several
+            # transforms
+            self.__dict__['_matrix'] = None
+            self._invalidate_world_matrix()
+            self._invalidate_extents(True)
+            self.redraw()
+            return
 
-        if name in self.cache_attrs or name in self.graphics_unrelated_attrs:
+        if kind == "cache":
             return
 
         """all the other changes influence cache vars"""
 
-        if name == 'visible' and self.visible == False:
-            # when transforms happen while sprite is invisible
-            for sprite in self.sprites:
-                sprite._prev_parent_matrix = None
+        if name == 'visible':
+            # hidden sprites are kept out of the spatial index, so they have
+            # to be dropped from it as well as put back in
+            self._invalidate_extents(True)
+        elif name == 'interactive':
+            self._invalidate_extents()
 
 
-        # on moves invalidate our matrix, child extent cache (as that depends on our transforms)
-        # as well as our parent's child extents as we moved
-        # then go into children and invalidate the parent matrix down the tree
-        if name in self.transformation_attrs:
-            self._matrix = None
-            for sprite in self.sprites:
-                sprite._prev_parent_matrix = None
-        elif name not in self.visibility_attrs:
+        if name not in self.visibility_attrs:
             # if attribute is not in transformation nor visibility, we conclude
             # that it must be causing the sprite needs re-rendering
             self.__dict__["_sprite_dirty"] = True
 
         # on parent change invalidate the matrix
         if name == 'parent':
-            self._prev_parent_matrix = None
+            self._invalidate_world_matrix()
             return
 
         if name == 'opacity' and getattr(self, "cache_as_bitmap", None) and hasattr(self, "graphics"):
@@ -993,12 +2221,48 @@ class Sprite(Parent, gobject.GObject):
             self.graphics._last_matrix = None
 
         if name == 'z_order' and getattr(self, "parent", None):
-            self.parent._sort()
+            self.parent._z_move(self)
+            self._invalidate_extents(True) # changes what's on top, children included
 
 
         self.redraw()
 
 
+    @classmethod
+    def _get_attr_kind(cls, name):
+        """tells how setting the attribute affects the sprite - one of
+        "property", "parent_matrix", "cache", "transform" or "other".
+        the result is kept per class, so the attribute sets are to be
+        overridden on the class rather than on the instance"""
+        prop = getattr(cls, name, None)
+        if isinstance(prop, property) and prop.fset is not None:
+            return "property"
+        elif name == '_prev_parent_matrix':
+            return "parent_matrix"
+        elif name in cls.cache_attrs or name in cls.graphics_unrelated_attrs:
+            return "cache"
+        elif name in cls.transformation_attrs:
+            return "transform"
+        return "other"
+
+    def _invalidate_world_matrix(self):
+        """forget the cached world matrix of the sprite and all its
+        children, as well as their bounds that depend on it"""
+        self.__dict__['_world_matrix'] = None
+        self.__dict__['_world_inverse'] = None
+        self.__dict__['_world_generation'] = self.__dict__.get('_world_generation', 0) + 1
+        self.__dict__.pop('_bounds', None)
+        self.__dict__.pop('_cull_bounds', None)
+        for sprite in self.__dict__.get('sprites', ()):
+            sprite._invalidate_world_matrix()
+
+    def _invalidate_extents(self, subtree = False):
+        """let the scene's spatial index know that our extents, and those of
+        our children if `subtree` is set, have to be measured again"""
+        scene = self.get_scene()
+        if scene is not None:
+            scene._spatial_index.invalidate(self, subtree)
+
     def _get_mouse_cursor(self):
         """Determine mouse cursor.
         By default look for self.mouse_cursor is defined and take that.
@@ -1054,7 +2318,7 @@ class Sprite(Parent, gobject.GObject):
         """returns all the parent sprites up until scene"""
         res = []
         parent = self.parent
-        while parent and isinstance(parent, Scene) == False:
+        while isinstance(parent, Sprite):
             res.insert(0, parent)
             parent = parent.parent
 
@@ -1063,29 +2327,121 @@ class Sprite(Parent, gobject.GObject):
 
     def get_extents(self):
         """measure the extents of the sprite's graphics."""
-        if self._sprite_dirty:
+        scene = self.get_scene()
+        if scene is None or not scene.profiler:
+            return self._get_extents()
+
+        started = time.perf_counter()
+        extents = self._get_extents(scene.profiler)
+        scene.profiler.add("extents", started, self)
+        return extents
+
+    def _get_extents(self, profiler = None):
+        version = self.graphics._version
+        if self._render(profiler):
             # redrawing merely because we need fresh extents of the sprite
             context = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 0, 0))
-            context.transform(self.get_matrix())
-            self.emit("on-render")
-            self.__dict__["_sprite_dirty"] = False
+            context.transform(self._get_world_matrix())
             self.graphics._draw(context, 1)
 
 
-        if not self.graphics.paths:
-            self.graphics._draw(cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 0, 0)), 1)
+        paths = self.graphics._capture_paths()
+        if self.graphics._version != version:
+            # our clip paths also limit the children
+            self._invalidate_extents(True)
 
-        if not self.graphics.paths:
+        if not paths:
             return None
 
+        # nothing has changed since the last time - neither our graphics and
+        # transformations, nor those of our parents
+        key = self._get_extents_key()
+        cached = self.__dict__.get('_extents_cache')
+        if cached and cached[0] == key:
+            return cached[1]
+
+        ext, context = self._measure_extents()
+
+        # the context is needed for precise hit checks, and that is
+        # something only interactive sprites get
+        self.__dict__['_stroke_context'] = context if self.interactive else None
+        self.__dict__['_extents_cache'] = (self._get_extents_key(), ext)
+        return ext
+
+    def _render(self, profiler = None):
+        """emit "on-render" if the sprite has changed since it was last drawn.
+        Sprites with :attr:`lod_scales` switch to the graphics of the current
+        level of detail and get "on-render-lod" if the level has not been
+        drawn since the last change. Returns True if anything got rendered"""
+        if not self.lod_scales:
+            if not self._sprite_dirty:
+                return False
+            signal, args = "on-render", ()
+        else:
+            level = self._get_lod_level()
+            levels = self.__dict__.setdefault('_lod_graphics', {})
+            rendered = self.__dict__.setdefault('_lod_rendered', set())
+            if self._sprite_dirty:
+                rendered.clear()
+
+            graphics = levels.get(level)
+            if graphics is None:
+                graphics = levels[level] = Graphics()
+            if graphics is not self.graphics:
+                self.__dict__['graphics'] = graphics
+                self._invalidate_extents(True)
+                self._forget_bounds()
+
+            if level in rendered:
+                return False
+            rendered.add(level)
+            signal, args = "on-render-lod", (level,)
+
+        started = time.perf_counter() if profiler else None
+        self.emit(signal, *args)
+        if started:
+            profiler.add("render", started, self)
+        self.__dict__["_sprite_dirty"] = False
+        return True
+
+    def _get_lod_level(self):
+        """the level of detail for the scale the sprite is on screen at"""
+        matrix = self._get_world_matrix()
+        scale = math.sqrt(abs(matrix.xx * matrix.yy - matrix.xy * matrix.yx))
+
+        scene = self.get_scene()
+        if isinstance(scene, Scene):
+            aspect_x, aspect_y = scene._get_aspect_x_y()
+            scale *= math.sqrt(aspect_x * aspect_y)
+
+        levels = sorted(self.lod_scales)
+        for level in levels:
+            if level >= scale:
+                return level
+        return levels[-1]
+
+    def _get_extents_key(self):
+        """returns what our extents depend on - our world matrix generation
+        and the graphics versions of the sprite and all its parents"""
+        key, sprite = [self._world_generation], self
+        while isinstance(sprite, Sprite):
+            # levels of detail have graphics of their own
+            key.append((sprite, sprite.graphics, sprite.graphics._version))
+            sprite = sprite.parent
+        return key
+
+    def _measure_extents(self):
+        """replays the paths of the sprite to find out its scene-space
+        extents. returns the extents and the context with the paths, for hit
+        checks"""
         context = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 0, 0))
 
         # bit of a hack around the problem - looking for clip instructions in parent
         # so extents would not get out of it
         clip_extents = None
         for parent in self.get_parents():
-            context.transform(parent.get_local_matrix())
-            if parent.graphics.paths:
+            context.set_matrix(parent._get_world_matrix())
+            if parent.graphics._capture_paths():
                 clip_regions = []
                 for instruction, type, path in parent.graphics.paths:
                     if instruction == "clip":
@@ -1103,7 +2459,7 @@ class Sprite(Parent, gobject.GObject):
                     ext = get_gdk_rectangle(int(ext[0]), int(ext[1]), int(ext[2] - ext[0]), int(ext[3] - ext[1]))
                     intersect, clip_extents = gdk.rectangle_intersect((clip_extents or ext), ext)
 
-        context.transform(self.get_local_matrix())
+        context.set_matrix(self._get_world_matrix())
 
         for instruction, type, path in self.graphics.paths:
             if type == "path":
@@ -1123,9 +2479,105 @@ class Sprite(Parent, gobject.GObject):
         if not ext.width and not ext.height:
             ext = None
 
-        self.__dict__['_stroke_context'] = context
+        return ext, context
+
+
+    def get_bounds(self):
+        """returns scene-space bounding box of the sprite's graphics together
+        with all of its visible children as a gdk.Rectangle. The result is
+        cached until the sprite or any of its children change.
+        Returns None when the area can't be told, for example when the sprite
+        paints without a path (pathless paint or show_text), or when it or any
+        of its children is not :attr:`cullable`"""
+        if '_bounds' in self.__dict__:
+            return self.__dict__['_bounds']
+
+        bounds = self.get_extents() if self.cullable else None
+        if bounds is None and self.cullable and \
+           (self.graphics.paths or not self.graphics._has_instructions()):
+            bounds = get_gdk_rectangle(0, 0, 0, 0) # nothing to draw
+
+        if bounds is not None:
+            for sprite in self._z_ordered_sprites:
+                if not sprite.visible:
+                    continue
+                child_bounds = sprite.get_bounds()
+                if child_bounds is None:
+                    bounds = None
+                    break
+                bounds = _rectangle_union(bounds, child_bounds)
+
+        self.__dict__['_bounds'] = bounds
+        return bounds
+
+    def _pop_drawn_bounds(self):
+        """returns and forgets where the sprite was drawn the last time. False
+        if it has not been drawn since, None if the place is not known"""
+        return self.__dict__.pop('_drawn_bounds', False)
+
+    def _get_cull_bounds(self):
+        """scene-space box around what the sprite and its visible children
+        drew the last time, for culling. As opposed to :func:`get_bounds`, it
+        is the ink extents of the graphics put through the world matrix, so
+        moves don't have the sprite rendered or measured again. None when not
+        known, which is also the case when the sprite or any of its children
+        is dirty or not :attr:`cullable`"""
+        if '_cull_bounds' in self.__dict__:
+            return self.__dict__['_cull_bounds']
+
+        bounds = self._get_graphics_cull_bounds()
+        if bounds is not None:
+            for sprite in self._z_ordered_sprites:
+                if not sprite.visible:
+                    continue
+                child_bounds = sprite._get_cull_bounds()
+                if child_bounds is None:
+                    bounds = None
+                    break
+                bounds = _rectangle_union(bounds, child_bounds)
+
+        self.__dict__['_cull_bounds'] = bounds
+        return bounds
+
+    def _get_graphics_cull_bounds(self):
+        """scene-space box around the graphics of the sprite, without the
+        children. None when not known"""
+        if not self.cullable or self._sprite_dirty:
+            return None # a dirty sprite might draw anywhere once rendered
+
+        version = self.graphics._version
+        ink = self.graphics._get_ink_extents()
+        if self.graphics._version != version:
+            self._invalidate_extents(True)
+
+        if ink is False:
+            return None # painting everywhere, or changing all the time
+        if ink is None:
+            return get_gdk_rectangle(0, 0, 0, 0) # nothing to draw
+        return _transform_box(self._get_world_matrix(), *ink)
+
+    def _forget_bounds(self):
+        """drop the cached bounds of the sprite and of its parents. stops as
+        soon as we meet a parent with unknown bounds, as that means the ones
+        above are also unknown (or we are not part of them)"""
+        self.__dict__.pop('_bounds', None)
+        self.__dict__.pop('_cull_bounds', None)
+        parent = getattr(self, "parent", None)
+        while isinstance(parent, Sprite) and \
+              ('_bounds' in parent.__dict__ or '_cull_bounds' in parent.__dict__):
+            parent.__dict__.pop('_bounds', None)
+            parent.__dict__.pop('_cull_bounds', None)
+            parent = parent.parent
 
-        return ext
+    def _in_clip(self, clip):
+        """false if the sprite with all its children is known to be entirely
+        outside of the given scene-space rectangle, or has nothing to draw"""
+        bounds = self._get_cull_bounds()
+        if bounds is None:
+            return True
+        if not bounds.width and not bounds.height:
+            return False
+        return _rectangles_touch(bounds, clip)
 
 
     def check_hit(self, x, y):
@@ -1136,7 +2588,13 @@ class Sprite(Parent, gobject.GObject):
             return False
 
         if extents.x <= x <= extents.x + extents.width and extents.y <= y <= extents.y + extents.height:
-            return self._stroke_context is None or self._stroke_context.in_fill(x, y)
+            context = self._stroke_context
+            if context is None:
+                # we keep the paths around only for sprites that take mouse
+                context = self._measure_extents()[1]
+                if self.interactive:
+                    self.__dict__['_stroke_context'] = context
+            return context.in_fill(x, y)
         else:
             return False
 
@@ -1154,9 +2612,48 @@ class Sprite(Parent, gobject.GObject):
            during scene redraw are ignored in order to avoid echoes.
            Call scene.redraw() explicitly if you need to redraw in these cases.
         """
+        # our bounds and so the bounds of our parents are not valid anymore
+        self._forget_bounds()
+
         scene = self.get_scene()
         if scene:
-            scene.redraw()
+            scene._redraw_sprite(self)
+
+    def update(self, **attrs):
+        """set several attributes at once, invalidating the sprite just once
+        for all of them rather than on every attribute. Example::
+
+            sprite.update(x = 10, y = 20, rotation = 0.5, opacity = 0.8)
+        """
+        scene = self.get_scene()
+        if scene is not None and not scene._batch_depth:
+            with scene.batch():
+                return self.update(**attrs)
+
+        transformed = False
+        if type(self).__setattr__ is Sprite.__setattr__:
+            # transformations are written straight away, without going
+            # through the invalidation for each of them
+            for name in list(attrs):
+                if type(self)._get_attr_kind(name) != "transform":
+                    continue
+                val = attrs.pop(name)
+                prev = self.__dict__.get(name, "hamster_graphics_no_value_really")
+                if type(prev) == type(val) and prev == val:
+                    continue
+                self.__dict__[name] = val
+                transformed = True
+
+        if transformed:
+            self.__dict__['_matrix'] = None
+            self._invalidate_world_matrix()
+            self._invalidate_extents(True)
+
+        for name, val in attrs.items():
+            setattr(self, name, val)
+
+        if transformed:
+            self.redraw()
 
     def animate(self, duration = None, easing = None, on_complete = None,
                 on_update = None, round = False, **kwargs):
@@ -1185,6 +2682,11 @@ class Sprite(Parent, gobject.GObject):
             scene.stop_animation(self)
 
     def get_local_matrix(self):
+        """return sprite's transformation matrix relative to the parent"""
+        return cairo.Matrix() * self._get_local_matrix()
+
+    def _get_local_matrix(self):
+        """the cached local matrix. don't modify!"""
         if self._matrix is None:
             matrix, x, y, pivot_x, pivot_y = cairo.Matrix(), self.x, self.y, self.pivot_x, self.pivot_y
 
@@ -1208,53 +2710,84 @@ class Sprite(Parent, gobject.GObject):
 
             self._matrix = matrix
 
-        return cairo.Matrix() * self._matrix
+        return self._matrix
 
 
     def get_matrix(self):
-        """return sprite's current transformation matrix"""
-        if self.parent:
-            return self.get_local_matrix() * (self._prev_parent_matrix or self.parent.get_matrix())
-        else:
-            return self.get_local_matrix()
+        """return sprite's current transformation matrix, relative to the
+        scene and not including the scene's scale"""
+        return cairo.Matrix() * self._get_world_matrix()
+
+    def _get_world_matrix(self):
+        """the cached matrix from sprite's coordinates to the scene's. it is
+        kept until we or any of our parents move. don't modify!"""
+        matrix = self._world_matrix
+        if matrix is None:
+            matrix = self._get_local_matrix()
+            if isinstance(self.parent, Sprite):
+                matrix = matrix * self.parent._get_world_matrix()
+            self.__dict__['_world_matrix'] = matrix
+        return matrix
+
+    def _get_world_inverse(self):
+        """the cached inverse of :func:`_get_world_matrix`. don't modify!"""
+        inverse = self._world_inverse
+        if inverse is None:
+            inverse = cairo.Matrix() * self._get_world_matrix()
+            inverse.invert()
+            self.__dict__['_world_inverse'] = inverse
+        return inverse
 
 
     def from_scene_coords(self, x=0, y=0):
         """Converts x, y given in the scene coordinates to sprite's local ones
         coordinates"""
-        matrix = self.get_matrix()
-        matrix.invert()
-        return matrix.transform_point(x, y)
+        return self._get_world_inverse().transform_point(x, y)
 
     def to_scene_coords(self, x=0, y=0):
         """Converts x, y from sprite's local coordinates to scene coordinates"""
-        return self.get_matrix().transform_point(x, y)
+        return self._get_world_matrix().transform_point(x, y)
 
     def _draw(self, context, opacity = 1, parent_matrix = None):
         if self.visible is False:
             return
 
-        if (self._sprite_dirty): # send signal to redo the drawing when sprite is dirty
-            self.emit("on-render")
-            self.__dict__["_sprite_dirty"] = False
+        scene = self.get_scene()
+        profiler = scene.profiler if scene else None
 
+        if self._render(profiler): # send signal to redo the drawing when sprite is dirty
+            self._forget_bounds() # unknown bounds of a dirty sprite might be known now
 
-        no_matrix = parent_matrix is None
-        parent_matrix = parent_matrix or cairo.Matrix()
 
-        # cache parent matrix
-        self._prev_parent_matrix = parent_matrix
+        parent_matrix = parent_matrix or cairo.Matrix()
 
-        matrix = self.get_local_matrix()
+        matrix = self._get_local_matrix()
 
         context.save()
         context.transform(matrix)
 
-
-        if self.cache_as_bitmap:
-            self.graphics._draw_as_bitmap(context, self.opacity * opacity)
+        version = self.graphics._version
+        started = time.perf_counter() if profiler else None
+        if self.cache_as_bitmap == "transform":
+            self.graphics._draw_as_transformed_bitmap(context, self.opacity * opacity,
+                                                      scene.bitmap_cache if scene else None,
+                                                      self.bitmap_scale,
+                                                      self.bitmap_scale_tolerance)
+        elif self.cache_as_bitmap:
+            self.graphics._draw_as_bitmap(context, self.opacity * opacity,
+                                          scene.bitmap_cache if scene else None)
+        elif self.compile_graphics:
+            self.graphics._draw_compiled(context, self.opacity * opacity)
         else:
-            self.graphics._draw(context, self.opacity * opacity)
+            # paths are needed only for hit checks and extents, so leave them
+            # to be captured on demand for the sprites that don't take mouse
+            self.graphics._draw(context, self.opacity * opacity, self.interactive)
+        if started:
+            profiler.add("draw", started, self)
+
+        if self.graphics._version != version:
+            self._invalidate_extents(True)
+            self._forget_bounds()
 
         context.new_path() #forget about us
 
@@ -1269,7 +2802,7 @@ class Sprite(Parent, gobject.GObject):
                 context.identity_matrix()
 
                 scene = self.get_scene()
-                if scene:
+                if isinstance(scene, Scene):
                     # go figure - seems like the context we are given starts
                     # in window coords when calling identity matrix
                     scene_alloc = self.get_scene().get_allocation()
@@ -1281,18 +2814,24 @@ class Sprite(Parent, gobject.GObject):
                 context.stroke()
                 context.restore()
 
+        clip = scene._draw_clip if scene else None
+        if clip and self._z_ordered_sprites:
+            # our clip, if we have one, might leave out more of the children
+            clip = _transform_box(self._get_world_matrix(), *context.clip_extents())
+
         for sprite in self._z_ordered_sprites:
+            if clip and not sprite._in_clip(clip):
+                continue
             sprite._draw(context, self.opacity * opacity, matrix * parent_matrix)
 
 
         context.restore()
 
-        # having parent and not being given parent matrix means that somebody
-        # is calling draw directly - avoid caching matrix for such a case
-        # because when we will get called properly it won't be respecting
-        # the parent's transformations otherwise
-        if isinstance(self.parent, Sprite) and no_matrix:
-            self._prev_parent_matrix = None
+        if scene and scene.partial_redraw:
+            # remember where we were drawn so that we know what to repaint
+            # when we change
+            self.__dict__['_drawn_bounds'] = self.get_bounds()
+
 
     # using _do functions so that subclassees can override these
     def _do_mouse_down(self, event): self.emit("on-mouse-down", event)
@@ -1314,6 +2853,337 @@ class Sprite(Parent, gobject.GObject):
         return False
 
 
+class LightSprite(object):
+    """A leaner take on :class:`Sprite` for when there are thousands of
+    them. It is a plain python object with slots instead of a GObject, so it
+    is way quicker to create and takes a fraction of the memory. It gets
+    positioned, tweened, z-ordered and drawn the same way as the sprite
+    does, but it can't have children of its own and does not respond to
+    the mouse.
+
+    The graphics can be shared between many light sprites - draw the shape
+    once and pass the same :class:`Graphics` to all of them::
+
+        dot = graphics.Graphics()
+        dot.circle(0, 0, 3)
+        dot.fill("#f00")
+        scene.add_child(*[graphics.LightSprite(dot, x = i % 100 * 8, y = i // 100 * 8)
+                          for i in range(10000)])
+
+    Without graphics passed in, the sprite gets graphics of its own that
+    can be drawn in "on-render", just like with the sprite. Instead of
+    gobject signals there are plain callbacks, see :func:`connect`.
+    """
+
+    __slots__ = ('x', 'y', 'rotation', 'scale_x', 'scale_y', 'pivot_x', 'pivot_y',
+                 'opacity', 'visible', 'z_order', 'snap_to_pixel', 'graphics',
+                 'id', 'parent', '_scene', '_matrix', '_world_matrix',
+                 '_world_inverse', '_bounds', '_drawn_bounds', '_sprite_dirty',
+                 '_listeners')
+
+    transformation_attrs = Sprite.transformation_attrs
+
+    visibility_attrs = Sprite.visibility_attrs
+
+    cache_attrs = set(('parent', '_scene', '_matrix', '_world_matrix', '_world_inverse',
+                       '_bounds', '_drawn_bounds', '_sprite_dirty', '_listeners', 'id'))
+
+    # light sprites are leaves that the mouse goes through
+    sprites = ()
+    _z_ordered_sprites = ()
+    interactive = False
+    draggable = False
+    can_focus = False
+    focused = False
+    mouse_cursor = None
+    debug = False
+    cullable = True
+
+    def __init__(self, graphics = None, x = 0, y = 0, opacity = 1, visible = True,
+                 rotation = 0, pivot_x = 0, pivot_y = 0, scale_x = 1, scale_y = 1,
+                 z_order = 0, snap_to_pixel = True, id = None):
+        # nothing to invalidate yet, so skipping our __setattr__
+        for name, val in (('x', x), ('y', y), ('opacity', opacity), ('visible', visible),
+                          ('rotation', rotation), ('pivot_x', pivot_x), ('pivot_y', pivot_y),
+                          ('scale_x', scale_x), ('scale_y', scale_y), ('z_order', z_order),
+                          ('snap_to_pixel', snap_to_pixel), ('id', id),
+                          ('graphics', graphics or Graphics()),
+                          ('parent', None), ('_scene', None), ('_matrix', None),
+                          ('_world_matrix', None), ('_world_inverse', None),
+                          ('_bounds', False), ('_drawn_bounds', False),
+                          ('_sprite_dirty', True), ('_listeners', None)):
+            object.__setattr__(self, name, val)
+
+    def __setattr__(self, name, val):
+        if name in self.cache_attrs:
+            object.__setattr__(self, name, val)
+            if name == 'parent':
+                self._invalidate_world_matrix()
+            return
+
+        prev = getattr(self, name, "hamster_graphics_no_value_really")
+        if type(prev) == type(val) and prev == val:
+            return
+        object.__setattr__(self, name, val)
+
+        if name in self.transformation_attrs:
+            object.__setattr__(self, '_matrix', None)
+            self._invalidate_world_matrix()
+        elif name == 'z_order':
+            if self.parent is not None:
+                self.parent._z_move(self)
+        elif name not in self.visibility_attrs:
+            # same as with sprites - anything else means re-rendering
+            object.__setattr__(self, '_sprite_dirty', True)
+
+        self.redraw()
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.id or str(id(self)))
+
+
+    def connect(self, event, callback, *args):
+        """call `callback(sprite, *args)` whenever the event is emitted.
+        Returns handler id that can be passed to :func:`disconnect`"""
+        if self._listeners is None:
+            self._listeners = OrderedDict()
+        handler = next(_light_handler_ids)
+        self._listeners[handler] = (event, callback, args)
+        return handler
+
+    connect_after = connect
+
+    def disconnect(self, handler):
+        """stop calling the callback of the given handler id"""
+        if self._listeners:
+            self._listeners.pop(handler, None)
+            if not self._listeners:
+                self._listeners = None
+
+    def handler_is_connected(self, handler):
+        return bool(self._listeners) and handler in self._listeners
+
+    def emit(self, event, *args):
+        """call the callbacks connected to the event"""
+        if not self._listeners:
+            return
+        for handler_event, callback, handler_args in list(self._listeners.values()):
+            if handler_event == event:
+                callback(self, *(args + handler_args))
+
+
+    def find(self, id): return None
+    def traverse(self, attr_name = None, attr_value = None): return iter(())
+    def all_child_sprites(self): return iter(())
+    def get_mouse_sprites(self): return iter(())
+    def check_hit(self, x, y): return False
+    def has_focus(self): return False
+
+    # these only need the attributes and the matrices
+    bring_to_front = Sprite.bring_to_front
+    send_to_back = Sprite.send_to_back
+    get_parents = Sprite.get_parents
+    animate = Sprite.animate
+    stop_animation = Sprite.stop_animation
+    get_local_matrix = Sprite.get_local_matrix
+    _get_local_matrix = Sprite._get_local_matrix
+    get_matrix = Sprite.get_matrix
+    from_scene_coords = Sprite.from_scene_coords
+    to_scene_coords = Sprite.to_scene_coords
+    _in_clip = Sprite._in_clip
+    _get_cull_bounds = Sprite._get_graphics_cull_bounds
+
+    def get_scene(self):
+        """returns class:`Scene` the sprite belongs to"""
+        if self._scene is None and self.parent:
+            self._scene = self.parent.get_scene()
+        return self._scene
+
+    def update(self, **attrs):
+        """set several attributes at once, see :func:`Sprite.update`"""
+        scene = self.get_scene()
+        if scene is not None and not scene._batch_depth:
+            with scene.batch():
+                return self.update(**attrs)
+
+        for name, val in attrs.items():
+            setattr(self, name, val)
+
+    def redraw(self):
+        """queue redraw of the sprite. called automatically on changes"""
+        object.__setattr__(self, '_bounds', False)
+        if isinstance(self.parent, Sprite):
+            self.parent._forget_bounds()
+
+        scene = self.get_scene()
+        if scene:
+            scene._redraw_sprite(self)
+
+    def _invalidate_world_matrix(self):
+        object.__setattr__(self, '_world_matrix', None)
+        object.__setattr__(self, '_world_inverse', None)
+        object.__setattr__(self, '_bounds', False)
+
+    def _invalidate_extents(self, subtree = False):
+        pass # we are never in the spatial index
+
+    def _get_world_matrix(self):
+        """the cached matrix from sprite's coordinates to the scene's"""
+        matrix = self._world_matrix
+        if matrix is None:
+            matrix = self._get_local_matrix()
+            if isinstance(self.parent, Sprite):
+                matrix = matrix * self.parent._get_world_matrix()
+            object.__setattr__(self, '_world_matrix', matrix)
+        return matrix
+
+    def _get_world_inverse(self):
+        inverse = self._world_inverse
+        if inverse is None:
+            inverse = cairo.Matrix() * self._get_world_matrix()
+            inverse.invert()
+            object.__setattr__(self, '_world_inverse', inverse)
+        return inverse
+
+    def get_extents(self):
+        """measure the extents of the sprite's graphics."""
+        paths = self.graphics._capture_paths()
+        if not paths:
+            return None
+
+        context = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A1, 0, 0))
+        context.set_matrix(self._get_world_matrix())
+        for instruction, type, path in paths:
+            if type == "path":
+                context.append_path(path)
+            else:
+                getattr(context, instruction)(*path)
+        context.identity_matrix()
+
+        ext = context.path_extents()
+        ext = get_gdk_rectangle(int(ext[0]), int(ext[1]),
+                                int(ext[2] - ext[0]), int(ext[3] - ext[1]))
+        if not ext.width and not ext.height:
+            ext = None
+        return ext
+
+    def get_bounds(self):
+        """scene-space bounding box of the sprite's graphics, see
+        :func:`Sprite.get_bounds`"""
+        # the graphics might be shared, so we keep the version they were at
+        version = self.graphics._version
+        if self._bounds is not False and self._bounds[0] == version:
+            return self._bounds[1]
+
+        bounds = self.get_extents()
+        if bounds is None and (self.graphics.paths or not self.graphics._has_instructions()):
+            bounds = get_gdk_rectangle(0, 0, 0, 0) # nothing to draw
+
+        object.__setattr__(self, '_bounds', (version, bounds))
+        return bounds
+
+    def _pop_drawn_bounds(self):
+        bounds = self._drawn_bounds
+        object.__setattr__(self, '_drawn_bounds', False)
+        return bounds
+
+    def _draw(self, context, opacity = 1, parent_matrix = None):
+        if self.visible is False:
+            return
+
+        rendered = self._sprite_dirty
+        if rendered:
+            object.__setattr__(self, '_sprite_dirty', False)
+            self.emit("on-render")
+
+        version = self.graphics._version
+        context.save()
+        context.transform(self._get_local_matrix())
+        self.graphics._draw(context, self.opacity * opacity, False)
+        context.new_path()
+        context.restore()
+
+        if (rendered or self.graphics._version != version) and isinstance(self.parent, Sprite):
+            self.parent._forget_bounds()
+
+        scene = self.get_scene()
+        if scene and scene.partial_redraw:
+            object.__setattr__(self, '_drawn_bounds', self.get_bounds())
+
+
+class SpritePool(object):
+    """Keeps removed sprites of a class around for reuse, so that they don't
+    have to be created, connected to and rendered from scratch again. Upon
+    :func:`acquire` a pooled sprite gets its position, transformations,
+    opacity, visibility and z-order reset to the defaults (or to the
+    `defaults` passed in), and `reset(sprite)` is called if given. Use a pool
+    per sprite class, with :func:`Parent.reconcile` or on its own::
+
+        pool = graphics.SpritePool(Piece, reset = lambda piece: piece.graphics.clear())
+        piece = pool.acquire(x = 10, y = 20)
+        scene.add_child(piece)
+        ...
+        pool.release(piece) # takes it out of the scene too
+    """
+
+    #: attributes that get reset on the recycled sprites
+    defaults = {"x": 0, "y": 0, "rotation": 0, "scale_x": 1, "scale_y": 1,
+                "pivot_x": 0, "pivot_y": 0, "opacity": 1, "visible": True,
+                "z_order": 0}
+
+    def __init__(self, sprite_class = None, reset = None, max_size = None, **defaults):
+        #: class of the sprites in the pool. Defaults to :class:`Sprite`
+        self.sprite_class = sprite_class or Sprite
+
+        #: function called with the recycled sprite before it is handed out
+        self.reset = reset
+
+        #: how many free sprites to keep at most. unlimited when None
+        self.max_size = max_size
+
+        self.defaults = dict(self.defaults, **defaults)
+        self._constructor_args = defaults
+        self._free = []
+        self._pooled = set() # same as _free, for the membership checks
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self, **attrs):
+        """returns a recycled sprite with `attrs` set, or a new one when the
+        pool is empty"""
+        if not self._free:
+            return self.sprite_class(**dict(self._constructor_args, **attrs))
+
+        sprite = self._free.pop()
+        self._pooled.discard(sprite)
+        if self.reset:
+            self.reset(sprite)
+        sprite.update(**dict(self.defaults, **attrs))
+        return sprite
+
+    def release(self, *sprites):
+        """stop the sprites' animations, take them out of their parents and
+        put them in the pool. sprites that are in the pool already are
+        skipped"""
+        sprites = [sprite for sprite in OrderedDict.fromkeys(sprites)
+                   if sprite not in self._pooled]
+
+        by_parent = OrderedDict()
+        for sprite in sprites:
+            sprite.stop_animation()
+            if sprite.parent:
+                by_parent.setdefault(sprite.parent, []).append(sprite)
+
+        for parent, children in by_parent.items():
+            parent.remove_child(*children)
+
+        for sprite in sprites:
+            if self.max_size is None or len(self._free) < self.max_size:
+                self._free.append(sprite)
+                self._pooled.add(sprite)
+
+
 class BitmapSprite(Sprite):
     """Caches given image data in a surface similar to targets, which ensures
        that drawing it will be quick and low on CPU.
@@ -1428,6 +3298,8 @@ class Label(Sprite):
 
     cache_attrs = Sprite.cache_attrs | set(("_letter_sizes", "__surface", "_ascent", "_bounds_width", "_measures"))
 
+    graphics_unrelated_attrs = Sprite.graphics_unrelated_attrs | set(("__surface", "_bounds_width", "_measures"))
+
     def __init__(self, text = "", size = None, color = None,
                  alignment = pango.Alignment.LEFT, single_paragraph = False,
                  max_width = None, wrap = None, ellipsize = None, markup = "",
@@ -1488,8 +3360,6 @@ class Label(Sprite):
 
         self.connect("on-render", self.on_render)
 
-        self.graphics_unrelated_attrs = self.graphics_unrelated_attrs | set(("__surface", "_bounds_width", "_measures"))
-
     def __setattr__(self, name, val):
         if name == "font_desc":
             if isinstance(val, str):
@@ -1712,6 +3582,49 @@ class Circle(Sprite):
         self.graphics.fill_stroke(self.fill, self.stroke, line_width = self.line_width)
 
 
+class FrameGraph(Sprite):
+    """Overlay with a bar graph of the recent frame times as recorded by
+    the scene's :class:`FrameProfiler`. The line marks the frame budget of
+    the scene's framerate, bars over it are painted red. Added by
+    :func:`Scene.start_profiling` when asked for"""
+    def __init__(self, profiler, width = 240, height = 60, budget = 1 / 60.0, **kwargs):
+        Sprite.__init__(self, **kwargs)
+
+        #: :class:`FrameProfiler` to take the frames from
+        self.profiler = profiler
+
+        #: graph width in pixels. one bar per frame, as many as fit
+        self.width = width
+
+        #: graph height in pixels. twice the budget fits in
+        self.height = height
+
+        #: frame time, in seconds, that marks the frame budget
+        self.budget = budget
+
+        self.connect("on-render", self.on_render)
+
+    def _draw(self, context, opacity = 1, parent_matrix = None):
+        # always show the latest frames
+        self.__dict__["_sprite_dirty"] = True
+        Sprite._draw(self, context, opacity, parent_matrix)
+
+    def on_render(self, sprite):
+        self.graphics.rectangle(0, 0, self.width, self.height)
+        self.graphics.fill("#000", 0.6)
+
+        frames = list(self.profiler.frames)[-(self.width // 2):]
+        scale = self.height / (self.budget * 2.0)
+        for i, frame in enumerate(frames):
+            bar = min(frame["duration"] * scale, self.height)
+            self.graphics.rectangle(i * 2, self.height - bar, 1, bar)
+            self.graphics.fill("#f00" if frame["duration"] > self.budget else "#8ae234")
+
+        self.graphics.move_to(0, self.height / 2.0 + 0.5)
+        self.graphics.line_to(self.width, self.height / 2.0 + 0.5)
+        self.graphics.stroke("#fff", 0.5)
+
+
 class Scene(Parent, gtk.DrawingArea):
     """ Drawing area for displaying sprites.
         Add sprites to the Scene by calling :func:`add_child`.
@@ -1747,7 +3660,7 @@ class Scene(Parent, gtk.DrawingArea):
 
     def __init__(self, interactive = True, framerate = 60,
                        background_color = None, scale = False, keep_aspect = True,
-                       style_class=None):
+                       style_class=None, partial_redraw = False):
         gtk.DrawingArea.__init__(self)
 
         self._style = self.get_style_context()
@@ -1760,13 +3673,23 @@ class Scene(Parent, gtk.DrawingArea):
         self.sprites = []
 
         self._z_ordered_sprites = []
+        self.__dict__['_z_keys'] = [] # (z_order, sequence) of the above
+        self.__dict__['_z_key_of'] = {}
 
         # a place where to store child handlers
         self.__dict__['_child_handlers'] = defaultdict(list)
 
+        # see batch()
+        self._batch_depth = 0
+        self._batch_sorts = set()
+        self._batch_resizes = OrderedDict()
+        self._batch_frame_queued = False
+
         #: framerate of animation. This will limit how often call for
         #: redraw will be performed (that is - not more often than the framerate). It will
-        #: also influence the smoothness of tweeners.
+        #: also influence the smoothness of tweeners. The frames are synced
+        #: to the screen refresh, so the actual rate is the closest one the
+        #: display allows. Set to None to draw on every screen refresh.
         self.framerate = framerate
 
         #: Scene width. Will be `None` until first expose (that is until first
@@ -1789,6 +3712,14 @@ class Scene(Parent, gtk.DrawingArea):
         #: read only info about current framerate (frames per second)
         self.fps = None # inner frames per second counter
 
+        #: read only. intervals between the recent animation frames, in
+        #: seconds. See :func:`get_frame_stats` for a summary
+        self.frame_times = deque(maxlen=240)
+
+        #: read only. number of frames that did not make it in time, because
+        #: the previous frame took too long or the main loop was busy
+        self.skipped_frames = 0
+
         self._window = None # scenes don't really get reparented
 
         #: Last known x position of the mouse (set on expose event)
@@ -1811,7 +3742,11 @@ class Scene(Parent, gtk.DrawingArea):
 
         self._blank_cursor = gdk.Cursor(gdk.CursorType.BLANK_CURSOR)
 
-        self.__previous_mouse_signal_time = None
+        self.__pending_mouse_move = None # latest motion event, processed on next frame
+
+        # what we knew about the sprite under the mouse at the last hit check
+        self.__mouse_cells = None # (index cells, their generations)
+        self.__mouse_occluders = []
 
 
         #: Miminum distance in pixels for a drag to occur
@@ -1827,7 +3762,8 @@ class Scene(Parent, gtk.DrawingArea):
         self._mouse_in = False
         self.__last_cursor = None
 
-        self.__drawing_queued = False
+        self.__drawing_queued = False # there is a tick callback waiting for the next frame
+        self.__tick_resumed = False # the tick callback got added after a break
 
         #: When specified, upon window resize the content will be scaled
         #: relative to original window size. Defaults to False.
@@ -1839,9 +3775,46 @@ class Scene(Parent, gtk.DrawingArea):
 
         self._original_width, self._original_height = None,  None
 
-        self._focus_sprite = None # our internal focus management
+        #: When enabled, sprite changes repaint just the area the sprite
+        #: occupied before and after the change, instead of the whole scene.
+        #: Sprites are expected to draw within their paths (the way
+        #: :class:`Label` clips to its rectangle), and changes made in
+        #: on-enter-frame show up one frame late. Scene's :func:`redraw`
+        #: still repaints everything. Defaults to False.
+        self.partial_redraw = partial_redraw
+
+        #: Pixels to pad the damaged areas by, as the sprite extents do not
+        #: include line width and antialiasing
+        self.damage_margin = 5
+
+        self._damage = cairo.Region() # area to repaint, in widget coordinates
+        self._damaged_sprites = set() # sprites that we will have to measure before repaint
+        self._full_redraw = True
+        self._draw_clip = None # area being redrawn, in scene coordinates
+
+        #: :class:`SurfaceCache` holding the surfaces of the sprites that have
+        #: :attr:`Sprite.cache_as_bitmap` on. Adjust the memory budget and
+        #: check the hit/miss/eviction counters there.
+        self.bitmap_cache = SurfaceCache()
+
+        self._spatial_index = SpatialIndex(self) # for finding the sprite under the mouse
+
+        #: When enabled, the sprite under the mouse is looked up in an
+        #: offscreen buffer where every interactive sprite is painted in its
+        #: own color, instead of checking the sprite paths. Good for scenes
+        #: with thousands of interactive sprites. The buffer is drawn without
+        #: antialiasing so it can be a pixel off on the edges; set to "exact"
+        #: to check the paths of the sprites next to the mouse then.
+        #: Defaults to False.
+        self.pick_buffer = False
+        self._pick_buffer = None
+
+        #: :class:`FrameProfiler` recording the frame timings. None unless
+        #: profiling has been started with :func:`start_profiling`
+        self.profiler = None
+        self._frame_graph = None
 
-        self.__last_mouse_move = None
+        self._focus_sprite = None # our internal focus management
 
         if interactive:
             self.set_can_focus(True)
@@ -1954,21 +3927,190 @@ class Scene(Parent, gtk.DrawingArea):
         for sprite in sprites:
             self.tweener.kill_tweens(sprite)
 
+    @contextmanager
+    def batch(self):
+        """Context manager for changing lots of sprites at once. Within the
+        block the z-order sorting, widget resize requests and frame
+        scheduling are put on hold, and carried out once on the way out.
+        Batches can be nested, the outermost one does the work.
+        Example::
+
+            with scene.batch():
+                for sprite in scene.sprites:
+                    sprite.update(x = sprite.x + 10, z_order = sprite.y)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._flush_batch()
+
+    def _flush_batch(self):
+        """carry out the work held back by batch()"""
+        parents, self._batch_sorts = self._batch_sorts, set()
+        for parent in parents:
+            parent._sort()
+
+        widgets, self._batch_resizes = self._batch_resizes, OrderedDict()
+        for widget in widgets:
+            if widget.get_scene() is self: # still around
+                widget.queue_resize()
+
+        if self._batch_frame_queued:
+            # offscreen scenes don't queue frames, so this is a Scene
+            self._batch_frame_queued = False
+            self.__queue_frame()
+
 
     def redraw(self):
         """Queue redraw. The redraw will be performed not more often than
            the `framerate` allows"""
-        if self.__drawing_queued == False: #if we are moving, then there is a timeout somewhere already
+        self._full_redraw = True
+        self.__queue_frame()
+
+    def _redraw_sprite(self, sprite):
+        """Queue repaint of the area the sprite occupied in the last frame and
+        is occupying now. Falls back to full redraw unless
+        :attr:`partial_redraw` is on"""
+        if not self.partial_redraw:
+            self.redraw()
+            return
+
+        if not self._full_redraw:
+            bounds = sprite._pop_drawn_bounds()
+            if bounds is None:
+                self._full_redraw = True # no idea where it was
+            elif bounds is not False:
+                self._add_damage(bounds)
+            self._damaged_sprites.add(sprite)
+        self.__queue_frame()
+
+    def _add_damage(self, rect):
+        """add the scene-space gdk rectangle to the area to be repainted"""
+        if not rect.width and not rect.height:
+            return
+
+        aspect_x, aspect_y = self._get_aspect_x_y()
+        margin = self.damage_margin
+        x, y = int(math.floor(rect.x * aspect_x)) - margin, int(math.floor(rect.y * aspect_y)) - margin
+        x2 = int(math.ceil((rect.x + rect.width) * aspect_x)) + margin
+        y2 = int(math.ceil((rect.y + rect.height) * aspect_y)) + margin
+        self._damage.union(cairo.RectangleInt(x, y, x2 - x, y2 - y))
+
+    def __queue_frame(self):
+        if self._batch_depth:
+            self._batch_frame_queued = True
+            return
+
+        if self.__drawing_queued == False: #if we are moving, then the tick callback is there already
             self.__drawing_queued = True
-            self._last_frame_time = dt.datetime.now()
-            gobject.timeout_add(1000 / self.framerate, self.__redraw_loop)
+            self.__tick_resumed = True
+            self.add_tick_callback(self.__on_tick)
+
+    def __on_tick(self, widget, frame_clock):
+        """called by the frame clock before every screen refresh while we have
+        something to draw. loops until there is nothing more to tween"""
+        now = frame_clock.get_frame_time() / 1000000.0 # monotonic, in seconds
+
+        delta = 0
+        if self._last_frame_time is not None:
+            delta = now - self._last_frame_time
+            interval = 1.0 / self.framerate if self.framerate else 0
+
+            # ahead of the framerate - wait for another refresh. leaving some
+            # slack so that we don't fall below the framerate because of jitter
+            if delta < interval * 0.75:
+                return True
+
+            refresh_interval = frame_clock.get_refresh_info(frame_clock.get_frame_time())[0] / 1000000.0
+            interval = max(interval, refresh_interval)
+            if self.__tick_resumed and interval and delta > interval * 4:
+                # we have been idle rather than late, so there is no time
+                # to catch up on and nothing to measure
+                delta = 0
+            else:
+                if interval and delta > interval * 1.5:
+                    self.skipped_frames += int(round(delta / interval)) - 1
 
-    def __redraw_loop(self):
-        """loop until there is nothing more to tween"""
-        self.queue_draw() # this will trigger do_expose_event when the current events have been flushed
+                self.frame_times.append(delta)
+                self.fps = 1 / delta
 
-        self.__drawing_queued = self.tweener and self.tweener.has_tweens()
-        return self.__drawing_queued
+        self._last_frame_time = now
+        self.__tick_resumed = False
+
+        # update tweens before figuring out what to repaint, as they move things around
+        if self.tweener:
+            started = time.perf_counter() if self.profiler else None
+            self.tweener.update(delta)
+            if started:
+                self.profiler.add("tweens", started)
+
+        if self.partial_redraw and not self._full_redraw:
+            for sprite in self._damaged_sprites:
+                if sprite.visible and sprite.get_scene() == self:
+                    bounds = sprite.get_bounds()
+                    if bounds is None:
+                        self._full_redraw = True
+                        break
+                    self._add_damage(bounds)
+
+        if self.partial_redraw and not self._full_redraw:
+            self.queue_draw_region(self._damage)
+        else:
+            self.queue_draw() # this will trigger do_expose_event when the current events have been flushed
+
+        self._damage = cairo.Region()
+        self._damaged_sprites = set()
+        self._full_redraw = False
+
+        self.__drawing_queued = bool(self.tweener and self.tweener.has_tweens())
+        return self.__drawing_queued # returning false removes the tick callback
+
+
+    def start_profiling(self, frames = 300, overlay = False):
+        """start recording per-phase timings of every frame into a
+        :class:`FrameProfiler` that keeps the last `frames` frames. If
+        `overlay` is set, a :class:`FrameGraph` with recent frame times is
+        shown in the top left corner. Returns the profiler"""
+        self.stop_profiling()
+        self.profiler = FrameProfiler(frames)
+        if overlay:
+            self._frame_graph = FrameGraph(self.profiler, x = 5, y = 5, z_order = 100000,
+                                           budget = 1.0 / (self.framerate or 60))
+            self.add_child(self._frame_graph)
+        return self.profiler
+
+    def stop_profiling(self):
+        """stop recording the frame timings and remove the overlay. Returns
+        the profiler with the frames recorded so far"""
+        profiler, self.profiler = self.profiler, None
+        if self._frame_graph:
+            self.remove_child(self._frame_graph)
+            self._frame_graph = None
+        return profiler
+
+    def get_frame_stats(self):
+        """returns summary of the recent animation frames - the average
+        `fps`, frame time percentiles `p50`, `p90`, `p99` and `max` in
+        milliseconds, number of `frames` measured and `skipped_frames` in
+        total"""
+        times = sorted(self.frame_times)
+        if not times:
+            return {"frames": 0, "fps": None, "p50": None, "p90": None,
+                    "p99": None, "max": None, "skipped_frames": self.skipped_frames}
+
+        def percentile(fraction):
+            return times[min(int(len(times) * fraction), len(times) - 1)] * 1000
+
+        return {"frames": len(times),
+                "fps": len(times) / sum(times),
+                "p50": percentile(0.5),
+                "p90": percentile(0.9),
+                "p99": percentile(0.99),
+                "max": times[-1] * 1000,
+                "skipped_frames": self.skipped_frames}
 
 
     def do_draw(self, context):
@@ -1976,32 +4118,40 @@ class Scene(Parent, gtk.DrawingArea):
             aspect_x, aspect_y = self._get_aspect_x_y()
             context.scale(aspect_x, aspect_y)
 
-        if self.fps is None:
+        if self._window is None:
             self._window = self.get_window()
             self.emit("on-first-frame", context)
 
         cursor, self.mouse_x, self.mouse_y, mods = self._window.get_pointer()
 
+        # tweens are updated and fps measured in the tick callback. until
+        # there are frames to measure, go with the framerate we aim for
+        if self.fps is None:
+            self.fps = float(self.framerate or 60)
 
-        # update tweens
-        now = dt.datetime.now()
-        delta = (now - (self._last_frame_time or dt.datetime.now())).total_seconds()
-        self._last_frame_time = now
-        if self.tweener:
-            self.tweener.update(delta)
-
-        self.fps = 1 / delta
+        # skip the sprites that are entirely outside of the visible area, or
+        # of the damaged one on partial redraws
+        x1, y1, x2, y2 = context.clip_extents()
+        self._draw_clip = get_gdk_rectangle(int(math.floor(x1)), int(math.floor(y1)),
+                                            int(math.ceil(x2 - x1)), int(math.ceil(y2 - y1)))
 
         # start drawing
+        started = time.perf_counter() if self.profiler else None
         self.emit("on-enter-frame", context)
+        if started:
+            self.profiler.add("enter-frame", started)
+
         for sprite in self._z_ordered_sprites:
+            if self._draw_clip and not sprite._in_clip(self._draw_clip):
+                continue
             sprite._draw(context)
+        self._draw_clip = None
 
         self.__check_mouse(self.mouse_x, self.mouse_y)
         self.emit("on-finish-frame", context)
-
-        # reset the mouse signal time as redraw means we are good now
-        self.__previous_mouse_signal_time = None
+        self.bitmap_cache.next_frame()
+        if self.profiler:
+            self.profiler.end_frame()
 
 
     def do_configure_event(self, event):
@@ -2036,12 +4186,132 @@ class Scene(Parent, gtk.DrawingArea):
     def get_sprite_at_position(self, x, y):
         """Returns the topmost visible interactive sprite for given coordinates"""
         x, y = self.from_scene_coords(x, y)
-        over = None
-        for sprite in self.all_mouse_sprites():
-            if sprite.interactive and sprite.check_hit(x, y):
-                over = sprite
 
-        return over
+        if self.pick_buffer and self.width:
+            if self._pick_buffer is None:
+                self._pick_buffer = PickBuffer(self)
+            return self._pick_buffer.sprite_at(x, y, exact = self.pick_buffer == "exact")
+
+        # the spatial index gives us the few sprites that have the point
+        # within their extents. check the topmost first
+        candidates = []
+        for sprite in self._spatial_index.at(x, y):
+            path = self._get_mouse_path(sprite)
+            if path is not None:
+                candidates.append((path, sprite))
+
+        for path, sprite in sorted(candidates, key=lambda candidate: candidate[0], reverse=True):
+            if sprite.check_hit(x, y):
+                return sprite
+
+        return None
+
+    def query_rect(self, rect, contained = False):
+        """Returns the visible interactive sprites with extents that touch
+        the scene-space rectangle given as (x, y, width, height), in the
+        order they are drawn in - bottom-most first. If `contained` is set,
+        returns only the sprites that lie entirely within the rectangle.
+        Pass a list of rectangles or a numpy array of shape (n, 4) to get
+        a list of results, one per rectangle."""
+        rects, single = _split_query(rect, 4)
+        res = []
+        for x, y, w, h in rects:
+            sprites = self._spatial_index.in_rect(x, y, w, h)
+            if contained:
+                sprites = [sprite for sprite in sprites
+                           if _rectangle_in_polygon(sprite.get_extents(),
+                                                    [(x, y), (x + w, y), (x + w, y + h), (x, y + h)],
+                                                    True)]
+            res.append(self._sort_by_z(sprites))
+        return res[0] if single else res
+
+    def query_radius(self, point, radius):
+        """Returns the visible interactive sprites with extents within
+        `radius` from the scene-space point (x, y), bottom-most first.
+        Pass a list of points or a numpy array of shape (n, 2) to get a list
+        of results, one per point."""
+        points, single = _split_query(point, 2)
+        res = [self._sort_by_z(sprite for distance, sprite in self._spatial_index.near(x, y, radius))
+               for x, y in points]
+        return res[0] if single else res
+
+    def query_polygon(self, polygon, contained = False):
+        """Returns the visible interactive sprites with extents that touch
+        the scene-space polygon, bottom-most first. The polygon is a list
+        of (x, y) vertices or a numpy array of shape (n, 2). If `contained`
+        is set, returns only the sprites that lie entirely within it - handy
+        for lasso selection."""
+        vertices = _split_query(polygon, 2)[0]
+        if not vertices:
+            return []
+
+        xs, ys = [x for x, y in vertices], [y for x, y in vertices]
+        sprites = self._spatial_index.in_rect(min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+        return self._sort_by_z(sprite for sprite in sprites
+                               if _rectangle_in_polygon(sprite.get_extents(), vertices, contained))
+
+    def nearest(self, point, count = 1, max_distance = None):
+        """Returns up to `count` visible interactive sprites with extents
+        closest to the scene-space point (x, y), closest first. Of the sprites
+        at the same distance, the topmost goes first. Pass a list of points or a numpy
+        array of shape (n, 2) to get a list of results, one per point."""
+        points, single = _split_query(point, 2)
+        res = []
+        for x, y in points:
+            found = self._spatial_index.nearest(x, y, count, max_distance)
+            order = dict((sprite, i) for i, sprite in enumerate(self._sort_by_z(sprite for distance, sprite in found)))
+            res.append([sprite for distance, sprite in sorted(found, key=lambda item: (item[0], -order[item[1]]))])
+        return res[0] if single else res
+
+    def _sort_by_z(self, sprites):
+        """returns the sprites sorted in the order they are drawn in,
+        bottom-most first"""
+        # the z-order keys the parents keep sort the same as their z-ordered
+        # lists. only sprites that are not in the lists yet (waiting for a
+        # batch to end) need the positions worked out
+        positions = {}
+        def z_path(sprite):
+            path = []
+            while isinstance(sprite, Sprite):
+                parent = sprite.parent
+                key = parent._z_key_of.get(sprite)
+                if key is None:
+                    if parent not in positions:
+                        positions[parent] = dict((child, (child.z_order, i))
+                                                 for i, child in enumerate(parent.sprites))
+                    key = positions[parent].get(sprite, (-float("inf"), -1))
+                path.append(key)
+                sprite = parent
+            return path[::-1]
+
+        return sorted(sprites, key=z_path)
+
+    def _get_mouse_path(self, sprite):
+        """returns position of the sprite in the order :func:`all_mouse_sprites`
+        would list it in, from the scene down - a tuple of the z-order keys,
+        or of indexes for parents with their own get_mouse_sprites. the paths
+        only compare with one another. returns None if the sprite is not
+        visible to the mouse"""
+        path = []
+        while sprite is not self:
+            parent = sprite.parent
+            if parent is None or not sprite.visible:
+                return None
+
+            if type(parent).get_mouse_sprites is Parent.get_mouse_sprites:
+                # the z-order keys sort the same as the z-ordered list does
+                key = parent._z_key_of.get(sprite)
+                if key is None:
+                    return None
+                path.append(key)
+            else:
+                siblings = list(parent.get_mouse_sprites() or [])
+                if sprite not in siblings:
+                    return None
+                path.append(siblings.index(sprite))
+            sprite = parent
+
+        return tuple(reversed(path))
 
 
     def __check_mouse(self, x, y):
@@ -2061,7 +4331,14 @@ class Scene(Parent, gtk.DrawingArea):
 
         #check if we have a mouse over
         if self._drag_sprite is None:
-            over = self.get_sprite_at_position(x, y)
+            if self.__mouse_sprite_unchanged(x, y):
+                over = self._mouse_sprite
+            else:
+                started = time.perf_counter() if self.profiler else None
+                over = self.get_sprite_at_position(x, y)
+                self.__remember_mouse_sprite(over)
+                if started:
+                    self.profiler.add("mouse", started)
             if self._mouse_sprite and self._mouse_sprite != over:
                 self._mouse_sprite._do_mouse_out()
                 self.emit("on-mouse-out", self._mouse_sprite)
@@ -2091,21 +4368,70 @@ class Scene(Parent, gtk.DrawingArea):
             self.__last_cursor = cursor
 
 
+    def __mouse_sprite_unchanged(self, x, y):
+        """true if the mouse is still over the sprite it was over during the
+        last hit check, and nothing has moved since - so that checking again
+        would give the same answer"""
+        sprite = self._mouse_sprite
+        if sprite is None or not sprite.interactive:
+            return False
+
+        # anything that could change the answer - the sprite or its parents
+        # moving or changing, sprites coming or going on top of it - changes
+        # sprites in the cells it is in. elsewhere in the scene it doesn't
+        if self.__mouse_cells is None:
+            return False
+        cells, generations = self.__mouse_cells
+        if self._spatial_index.get_generations(cells) != generations:
+            return False
+
+        x, y = self.from_scene_coords(x, y)
+        if not sprite.check_hit(x, y):
+            return False
+
+        for extents in self.__mouse_occluders:
+            if extents.x <= x <= extents.x + extents.width and \
+               extents.y <= y <= extents.y + extents.height:
+                return False # might have moved over a sprite that is on top
+        return True
+
+    def __remember_mouse_sprite(self, sprite):
+        """note down the sprites on top of the one under the mouse so that we
+        know when the mouse might have moved over them"""
+        self.__mouse_occluders = []
+        self.__mouse_cells = None
+        extents = sprite.get_extents() if sprite else None
+        path = self._get_mouse_path(sprite) if extents else None
+        if path is None:
+            return
+
+        index = self._spatial_index
+        for other in index.in_rect(extents.x, extents.y, extents.width, extents.height):
+            other_path = self._get_mouse_path(other) if other is not sprite else None
+            if other_path is not None and other_path > path:
+                self.__mouse_occluders.append(other.get_extents())
+
+        cells = index.get_cells(extents.x, extents.y, extents.width, extents.height)
+        self.__mouse_cells = (cells, index.get_generations(cells))
+
+
     """ mouse events """
     def __on_mouse_move(self, scene, event):
-        if self.__last_mouse_move:
-            gobject.source_remove(self.__last_mouse_move)
-            self.__last_mouse_move = None
-
         self.mouse_x, self.mouse_y = event.x, event.y
 
-        # don't emit mouse move signals more often than every 0.05 seconds
-        timeout = dt.timedelta(seconds=0.05)
-        if self.__previous_mouse_signal_time and dt.datetime.now() - self.__previous_mouse_signal_time < timeout:
-            self.__last_mouse_move = gobject.timeout_add((timeout - (dt.datetime.now() - self.__previous_mouse_signal_time)).microseconds / 1000,
-                                                         self.__on_mouse_move,
-                                                         scene,
-                                                         event.copy())
+        # process just the latest of the motion events that arrive within a frame
+        if self.__pending_mouse_move is None:
+            self.add_tick_callback(self.__on_mouse_move_tick)
+        self.__pending_mouse_move = event.copy()
+
+    def __on_mouse_move_tick(self, widget, frame_clock):
+        self.__flush_mouse_move()
+        return False
+
+    def __flush_mouse_move(self):
+        """process the pending motion event, if any"""
+        event, self.__pending_mouse_move = self.__pending_mouse_move, None
+        if event is None:
             return
 
         state = event.state
@@ -2134,9 +4460,7 @@ class Scene(Parent, gtk.DrawingArea):
             diff_x, diff_y = event.x - self.__drag_start_x, event.y - self.__drag_start_y
             diff_x, diff_y = self.from_scene_coords(diff_x, diff_y)
             if isinstance(self._drag_sprite.parent, Sprite):
-                matrix = self._drag_sprite.parent.get_matrix()
-                matrix.invert()
-                diff_x, diff_y = matrix.transform_distance(diff_x, diff_y)
+                diff_x, diff_y = self._drag_sprite.parent._get_world_inverse().transform_distance(diff_x, diff_y)
 
             self._drag_sprite.x, self._drag_sprite.y = self._drag_sprite.drag_x + diff_x, self._drag_sprite.drag_y + diff_y
 
@@ -2150,7 +4474,6 @@ class Scene(Parent, gtk.DrawingArea):
             self._mouse_sprite._do_mouse_move(sprite_event)
 
         self.emit("on-mouse-move", event)
-        self.__previous_mouse_signal_time = dt.datetime.now()
 
 
     def start_drag(self, sprite, cursor_x = None, cursor_y = None):
@@ -2175,6 +4498,7 @@ class Scene(Parent, gtk.DrawingArea):
 
 
     def __on_button_press(self, scene, event):
+        self.__flush_mouse_move() # catch up with the pointer first
         target = self.get_sprite_at_position(event.x, event.y)
         if not self.__drag_started:
             self.__drag_start_x, self.__drag_start_y = event.x, event.y
@@ -2208,6 +4532,7 @@ class Scene(Parent, gtk.DrawingArea):
 
 
     def __on_button_release(self, scene, event):
+        self.__flush_mouse_move()
         target = self.get_sprite_at_position(event.x, event.y)
 
         if target:
@@ -2260,3 +4585,260 @@ class Scene(Parent, gtk.DrawingArea):
         if not handled:
             self.emit("on-key-release", event)
         return True
+
+
+class OffscreenScene(Parent, gobject.GObject):
+    """Window-less scene root that renders the sprite tree into a
+    :class:`cairo.ImageSurface`. Runs the same tweener, on-enter-frame and
+    sprite drawing pipeline as :class:`Scene`, but instead of waiting for the
+    framerate timeout the frames are produced on demand by calling
+    :func:`render_frame`. Does not need a display, so it can be used for
+    frame-time benchmarks, thumbnail generation and regression renders on
+    headless machines.
+
+    Example::
+
+        scene = graphics.OffscreenScene(400, 300, background_color="#fff")
+        scene.add_child(graphics.Rectangle(100, 100, fill="#f00", x=10, y=10))
+        scene.render_frame()
+        scene.write_to_png("rectangle.png")
+    """
+
+    __gsignals__ = {
+        "on-first-frame": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, )),
+        "on-enter-frame": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, )),
+        "on-finish-frame": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, )),
+        "on-resize": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT, )),
+
+        # never emitted, but widgets packed directly in the scene listen to these
+        "on-key-press": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+        "on-key-release": (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, (gobject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self, width, height, framerate = 60, background_color = None):
+        gobject.GObject.__init__(self)
+
+        #: list of sprites in scene. use :func:`add_child` to add sprites
+        self.sprites = []
+
+        self._z_ordered_sprites = []
+        self.__dict__['_z_keys'] = [] # (z_order, sequence) of the above
+        self.__dict__['_z_key_of'] = {}
+
+        # a place where to store child handlers
+        self.__dict__['_child_handlers'] = defaultdict(list)
+
+        # see Scene.batch()
+        self._batch_depth = 0
+        self._batch_sorts = set()
+        self._batch_resizes = OrderedDict()
+        self._batch_frame_queued = False
+
+        #: framerate of the animation. unless told otherwise, every
+        #: :func:`render_frame` call advances tweens by 1 / framerate seconds
+        self.framerate = framerate
+
+        #: Scene width. Use :func:`set_size` to change
+        self.width = width
+
+        #: Scene height. Use :func:`set_size` to change
+        self.height = height
+
+        #: instance of :class:`pytweener.Tweener` that is used by
+        #: :func:`animate` function, but can be also accessed directly for advanced control.
+        self.tweener = False
+        if pytweener:
+            self.tweener = pytweener.Tweener(0.4, pytweener.Easing.Cubic.ease_in_out)
+
+        #: instance of :class:`ColorUtils` class for color parsing
+        self.colors = Colors
+
+        #: read only info about how many frames per second the scene could
+        #: render, judging by how long the last frame took
+        self.fps = None
+
+        #: read only info about how long the last frame took to render, in seconds
+        self.frame_time = None
+
+        #: read only. render times of the recent frames, in seconds. See
+        #: :func:`get_frame_stats` for a summary
+        self.frame_times = deque(maxlen=240)
+
+        #: there is no screen refresh to miss, so always 0. Here for
+        #: compatibility with :class:`Scene`
+        self.skipped_frames = 0
+
+        #: number of frames rendered so far
+        self.frame = 0
+
+        # there is no pointer, but sprites look these up
+        self.mouse_x, self.mouse_y = None, None
+
+        #: Background color of the scene. Use either a string with hex color
+        #: or an RGB triplet. Transparent when not set
+        self.background_color = background_color
+
+        #: the surface the frames are rendered into. Recreated on first render
+        #: and after :func:`set_size`
+        self.surface = None
+
+        # offscreen scenes are never stretched, see Scene.scale
+        self.scale = False
+
+        # the whole surface is repainted on every frame, see Scene.partial_redraw
+        self.partial_redraw = False
+        self._draw_clip = None # the surface while rendering, for culling
+
+        #: :class:`SurfaceCache` holding the surfaces of bitmap-cached sprites
+        self.bitmap_cache = SurfaceCache()
+
+        self._spatial_index = SpatialIndex(self)
+
+        #: see :attr:`Scene.pick_buffer`
+        self.pick_buffer = False
+        self._pick_buffer = None
+
+        #: :class:`FrameProfiler`, see :func:`Scene.start_profiling`
+        self.profiler = None
+        self._frame_graph = None
+
+        self._focus_sprite = None
+
+        self._redraw_queued = False
+
+
+    def __setattr__(self, name, val):
+        if name == '_focus_sprite' and self.__dict__.get(name) != val:
+            prev_focus = self.__dict__.get('_focus_sprite')
+            if prev_focus:
+                prev_focus.focused = False
+                self.__dict__['_focus_sprite'] = val # drop cache to avoid echoes
+                prev_focus._do_blur()
+
+            if val:
+                val.focused = True
+                val._do_focus()
+
+        self.__dict__[name] = val
+
+    # scene functions that do not depend on having a window
+    animate = Scene.animate
+    stop_animation = Scene.stop_animation
+    from_scene_coords = Scene.from_scene_coords
+    to_scene_coords = Scene.to_scene_coords
+    get_matrix = Scene.get_matrix
+    _get_aspect_x_y = Scene._get_aspect_x_y
+    all_mouse_sprites = Scene.all_mouse_sprites
+    get_sprite_at_position = Scene.get_sprite_at_position
+    _get_mouse_path = Scene._get_mouse_path
+    query_rect = Scene.query_rect
+    query_radius = Scene.query_radius
+    query_polygon = Scene.query_polygon
+    nearest = Scene.nearest
+    _sort_by_z = Scene._sort_by_z
+    get_frame_stats = Scene.get_frame_stats
+    start_profiling = Scene.start_profiling
+    stop_profiling = Scene.stop_profiling
+    batch = Scene.batch
+    _flush_batch = Scene._flush_batch
+
+    def get_scene(self): return self
+
+    def set_size(self, width, height):
+        """change the size of the scene. the surface is recreated on the next
+        frame"""
+        if (width, height) == (self.width, self.height):
+            return
+        self.width, self.height = width, height
+        self.surface = None
+        self.emit("on-resize", None)
+
+    def redraw(self):
+        """Mark scene as in need of a new frame. Nothing is drawn until the
+        next :func:`render_frame` call"""
+        self._redraw_queued = True
+
+    def _redraw_sprite(self, sprite):
+        self.redraw()
+
+    def has_pending_frames(self):
+        """True if something has requested a redraw since the last frame or if
+        there are tweens running. Handy to render until the scene settles::
+
+            while scene.has_pending_frames():
+                scene.render_frame()
+        """
+        return self._redraw_queued or bool(self.tweener and self.tweener.has_tweens())
+
+    def render_frame(self, delta = None):
+        """Renders next frame and returns the :class:`cairo.ImageSurface` it
+        has been drawn on. `delta` is the time in seconds the tweens should
+        advance by. It defaults to 1 / framerate, so that renders are
+        reproducible, no matter how long the drawing itself took."""
+        if delta is None:
+            delta = 1.0 / self.framerate
+
+        if self.surface is None:
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                              int(self.width), int(self.height))
+
+        context = cairo.Context(self.surface)
+
+        # start from a clean slate as we are reusing the surface
+        context.save()
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        if self.background_color:
+            context.set_source_rgb(*self.colors.parse(self.background_color)[:3])
+        else:
+            context.set_source_rgba(0, 0, 0, 0)
+        context.paint()
+        context.restore()
+
+        start = time.perf_counter()
+        self._redraw_queued = False
+
+        if self.frame == 0:
+            self.emit("on-first-frame", context)
+
+        profiler = self.profiler
+        if profiler:
+            profiler.begin_frame(start)
+
+        if self.tweener:
+            started = time.perf_counter()
+            self.tweener.update(delta)
+            if profiler:
+                profiler.add("tweens", started)
+
+        started = time.perf_counter()
+        self.emit("on-enter-frame", context)
+        if profiler:
+            profiler.add("enter-frame", started)
+
+        # skip the sprites that are entirely off the surface
+        self._draw_clip = get_gdk_rectangle(0, 0, int(self.width), int(self.height))
+        for sprite in self._z_ordered_sprites:
+            if not sprite._in_clip(self._draw_clip):
+                continue
+            sprite._draw(context)
+        self._draw_clip = None
+
+        self.emit("on-finish-frame", context)
+        self.bitmap_cache.next_frame()
+        self.surface.flush()
+        if profiler:
+            profiler.end_frame()
+
+        self.frame += 1
+        self.frame_time = time.perf_counter() - start
+        self.fps = 1 / self.frame_time if self.frame_time else None
+        self.frame_times.append(self.frame_time)
+
+        return self.surface
+
+    def write_to_png(self, filename):
+        """saves last rendered frame as a png image. renders one if there have
+        been none so far"""
+        if self.surface is None:
+            self.render_frame()
+        self.surface.write_to_png(filename)
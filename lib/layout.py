@@ -240,6 +240,11 @@ class Widget(graphics.Sprite):
 
     def queue_resize(self):
         """request the element to re-check it's child sprite sizes"""
+        scene = self.get_scene()
+        if scene is not None and getattr(scene, "_batch_depth", 0):
+            scene._batch_resizes[self] = True # see graphics.Scene.batch
+            return
+
         self._children_resize_queued = True
         parent = getattr(self, "parent", None)
         if parent and isinstance(parent, graphics.Sprite) and hasattr(parent, "queue_resize"):
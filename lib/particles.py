@@ -0,0 +1,354 @@
+# - coding: utf-8 -
+
+# Copyright (c) 2014 Toms Baugis <toms.baugis@gmail.com>
+# Dual licensed under the MIT or GPL Version 2 licenses.
+
+"""Particle system sprite that keeps its particles in numpy arrays, so that
+moving and drawing tens of thousands of them is a handful of vectorized
+operations rather than a python loop. Requires numpy."""
+
+import math
+
+import cairo
+import numpy as np
+
+from . import graphics
+
+
+def gravity(x = 0, y = 100):
+    """force that pulls all particles in the same direction, in pixels per
+    second squared"""
+    pull = np.array([x, y], dtype=float)
+    def force(positions, velocities, ages):
+        return pull
+    return force
+
+def attractor(x, y, strength = 1000, min_distance = 5):
+    """force that pulls particles towards (x, y), weakening with the
+    distance. negative strength pushes them away"""
+    center = np.array([x, y], dtype=float)
+    def force(positions, velocities, ages):
+        delta = center - positions
+        distance = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), min_distance)
+        return delta * (strength / distance ** 2)[:, None]
+    return force
+
+
+def _range(value):
+    """(min, max) out of a number or a pair"""
+    if isinstance(value, (tuple, list)):
+        return value[0], value[1]
+    return value, value
+
+
+class Emitter(object):
+    """Spawns particles into the :class:`ParticleSystem` it is added to at
+    the given `rate` per second. `speed`, `angle` (radians) and `lifetime`
+    (seconds) can be single numbers or (min, max) ranges to pick randomly
+    from. `spread` is the radius around (x, y) the particles appear in"""
+    def __init__(self, x = 0, y = 0, rate = 100, speed = (50, 100),
+                 angle = (0, math.pi * 2), lifetime = (1, 2), color = "#fff",
+                 alpha = 1, size = 2, spread = 0):
+        self.x, self.y = x, y
+        self.rate = rate
+        self.speed = speed
+        self.angle = angle
+        self.lifetime = lifetime
+        self.color = color
+        self.alpha = alpha
+        self.size = size
+        self.spread = spread
+
+        #: set to False to pause the emitter
+        self.enabled = True
+
+        self._due = 0 # fractions of particles owed from the previous steps
+
+    def _step(self, system, dt):
+        if not self.enabled:
+            return
+        self._due += self.rate * dt
+        count = int(self._due)
+        self._due -= count
+        if count:
+            system.spawn(count, self.x, self.y, self.speed, self.angle,
+                         self.lifetime, self.color, self.alpha, self.size, self.spread)
+
+
+class ParticleSystem(graphics.Sprite):
+    """Sprite drawing lots of particles. Positions, velocities, colors,
+    sizes and ages of the particles are kept in packed numpy arrays (the
+    live particles are always the first :attr:`count` rows), and are
+    advanced all at once by :func:`step`.
+
+    `shape` is one of:
+
+    * "circle" - circles of the particle size in diameter
+    * "square" - squares of the particle size
+    * "pixel" - single pixels, written straight into an image surface.
+      Use this for 100k particles and up.
+
+    Circles and squares of the same color and transparency are drawn in a
+    single path, so particles of a few colors cost a few fills.
+
+    Call :func:`step` with the time passed every frame, for example::
+
+        particles = ParticleSystem(forces=[gravity(0, 200)])
+        particles.add_emitter(Emitter(200, 100, rate=500))
+        scene.add_child(particles)
+
+        def on_enter_frame(scene, context):
+            particles.step(1.0 / scene.framerate)
+        scene.connect("on-enter-frame", on_enter_frame)
+    """
+
+    # the particles move every frame, so measuring them to tell if they are
+    # on screen would cost more than drawing them
+    cullable = False
+
+    def __init__(self, capacity = 10000, shape = "circle", forces = None,
+                 damping = 0, integrator = "euler", fade_out = True,
+                 area = None, **kwargs):
+        graphics.Sprite.__init__(self, **kwargs)
+
+        #: maximum number of particles. once full, the oldest particles
+        #: make way for the new ones
+        self.capacity = capacity
+
+        #: "circle", "square" or "pixel"
+        self.shape = shape
+
+        #: list of functions taking positions, velocities and ages of the live
+        #: particles and returning their acceleration - either an (n, 2)
+        #: array or a single (x, y) for all. See :func:`gravity` and
+        #: :func:`attractor`
+        self.forces = list(forces or [])
+
+        #: how much of the velocity the particles lose per second, 0..1
+        self.damping = damping
+
+        #: "euler" (semi-implicit) or "verlet" (velocity verlet - steadier
+        #: with forces that depend on the position, but evaluates them twice)
+        self.integrator = integrator
+
+        #: whether the particles fade towards the end of their lifetime
+        self.fade_out = fade_out
+
+        #: (x, y, width, height) the pixels are drawn within in "pixel" mode.
+        #: defaults to the area of the scene
+        self.area = area
+
+        #: list of :class:`Emitter` instances. use :func:`add_emitter`
+        self.emitters = []
+
+        #: number of live particles
+        self.count = 0
+
+        #: random generator used for spawning
+        self.random = np.random.default_rng()
+
+        # numpy arrays won't compare in __setattr__, so around it they go
+        self.__dict__['positions'] = np.zeros((capacity, 2))
+        self.__dict__['velocities'] = np.zeros((capacity, 2))
+        self.__dict__['colors'] = np.zeros((capacity, 4)) # rgba, 0..1
+        self.__dict__['sizes'] = np.zeros(capacity)
+        self.__dict__['ages'] = np.zeros(capacity)
+        self.__dict__['lifetimes'] = np.zeros(capacity)
+
+        self.__dict__['_surface'] = None # for the pixel mode
+
+        self.connect("on-render", self.__on_render)
+
+
+    def add_emitter(self, emitter):
+        """add an :class:`Emitter` and return it"""
+        self.emitters.append(emitter)
+        return emitter
+
+    def remove_emitter(self, emitter):
+        self.emitters.remove(emitter)
+
+    def spawn(self, count, x = 0, y = 0, speed = 0, angle = (0, math.pi * 2),
+              lifetime = None, color = "#fff", alpha = 1, size = 2, spread = 0):
+        """add `count` particles at (x, y). `speed`, `angle` and `lifetime`
+        are numbers or (min, max) ranges, lifetime of None means forever.
+        Returns the slice of the arrays the new particles are in"""
+        count = min(count, self.capacity)
+        overflow = self.count + count - self.capacity
+        if overflow > 0:
+            self._keep(slice(overflow, self.count))
+
+        start, end = self.count, self.count + count
+        rand = self.random
+
+        angles = rand.uniform(*_range(angle), size=count)
+        speeds = rand.uniform(*_range(speed), size=count)
+        self.velocities[start:end, 0] = np.cos(angles) * speeds
+        self.velocities[start:end, 1] = np.sin(angles) * speeds
+
+        self.positions[start:end] = (x, y)
+        if spread:
+            offset_angles = rand.uniform(0, math.pi * 2, size=count)
+            offsets = np.sqrt(rand.uniform(0, 1, size=count)) * spread
+            self.positions[start:end, 0] += np.cos(offset_angles) * offsets
+            self.positions[start:end, 1] += np.sin(offset_angles) * offsets
+
+        self.colors[start:end, :3] = graphics.Colors.parse(color)[:3]
+        self.colors[start:end, 3] = alpha
+        self.sizes[start:end] = rand.uniform(*_range(size), size=count)
+        self.ages[start:end] = 0
+        if lifetime is None:
+            self.lifetimes[start:end] = np.inf
+        else:
+            self.lifetimes[start:end] = rand.uniform(*_range(lifetime), size=count)
+
+        self.count = end
+        return slice(start, end)
+
+    def clear_particles(self):
+        """drop all particles"""
+        self.count = 0
+        self._changed()
+
+    def _keep(self, which):
+        """keep just the given particles - a slice or a mask over the live
+        ones - and move them to the front of the arrays"""
+        live = slice(0, self.count)
+        for name in ('positions', 'velocities', 'colors', 'sizes', 'ages', 'lifetimes'):
+            values = self.__dict__[name]
+            kept = values[live][which]
+            values[:len(kept)] = kept
+        self.count = len(kept)
+
+    def _acceleration(self, positions, velocities, ages):
+        acceleration = np.zeros_like(positions)
+        for force in self.forces:
+            acceleration += force(positions, velocities, ages)
+        return acceleration
+
+    def step(self, dt):
+        """advance the particles by `dt` seconds: let the emitters spawn,
+        apply the forces, move the particles and recycle the expired ones"""
+        for emitter in self.emitters:
+            emitter._step(self, dt)
+
+        n = self.count
+        if n:
+            positions, velocities = self.positions[:n], self.velocities[:n]
+            ages = self.ages[:n]
+
+            acceleration = self._acceleration(positions, velocities, ages)
+            if self.integrator == "verlet":
+                positions += velocities * dt + acceleration * (0.5 * dt * dt)
+                new_acceleration = self._acceleration(positions, velocities, ages)
+                velocities += (acceleration + new_acceleration) * (0.5 * dt)
+            else:
+                velocities += acceleration * dt
+                positions += velocities * dt
+
+            if self.damping:
+                velocities *= (1 - self.damping) ** dt
+
+            ages += dt
+
+            alive = ages < self.lifetimes[:n]
+            if not alive.all():
+                self._keep(alive)
+
+        self._changed()
+
+    def _changed(self):
+        self.__dict__['_sprite_dirty'] = True
+        self.redraw()
+
+    def _get_alphas(self):
+        alphas = self.colors[:self.count, 3]
+        if self.fade_out:
+            alphas = alphas * np.clip(1 - self.ages[:self.count] / self.lifetimes[:self.count], 0, 1)
+        return alphas
+
+
+    def __on_render(self, sprite):
+        self.graphics.clear()
+        if not self.count:
+            return
+
+        if self.shape == "pixel":
+            self._render_pixels()
+        else:
+            self._render_shapes()
+
+    def _render_shapes(self):
+        n = self.count
+        positions, sizes = self.positions[:n], self.sizes[:n]
+        colors = self.colors[:n, :3]
+        alphas = self._get_alphas()
+
+        # bucket the particles by color and transparency, so that each bucket
+        # can go in a single fill
+        quantized = (colors * 255).astype(np.uint32)
+        keys = (quantized[:, 0] << 24) | (quantized[:, 1] << 16) | \
+               (quantized[:, 2] << 8) | (alphas * 31).astype(np.uint32)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        # the shapes of all the particles in one array, in bucket order. each
+        # bucket then passes its slice on in a single bulk instruction
+        x, y, size = positions[order, 0], positions[order, 1], sizes[order]
+        if self.shape == "square":
+            shapes, add_shapes = np.column_stack((x - size / 2, y - size / 2, size, size)), \
+                                 self.graphics.rectangles
+        else:
+            shapes, add_shapes = np.column_stack((x, y, size / 2)), self.graphics.circles
+
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1, [n]))
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            key = int(keys[start])
+            alpha = (key & 0xff) / 31.0
+            if alpha <= 0:
+                continue
+
+            add_shapes(shapes[start:end])
+            color = ((key >> 24) & 0xff, (key >> 16) & 0xff, (key >> 8) & 0xff)
+            self.graphics.fill([c / 255.0 for c in color], alpha)
+
+    def _render_pixels(self):
+        n = self.count
+        scene = self.get_scene()
+        if self.area:
+            x, y, width, height = self.area
+        elif scene is not None and scene.width and scene.height:
+            # the scene in our coordinates. it keeps its size as the particles
+            # come and go, and so the surface gets reused
+            box = graphics._transform_box(self._get_world_inverse(), 0, 0, scene.width, scene.height)
+            x, y, width, height = box.x, box.y, box.width, box.height
+        else:
+            x, y = np.floor(self.positions[:n].min(axis=0))
+            x2, y2 = np.ceil(self.positions[:n].max(axis=0)) + 1
+            width, height = x2 - x, y2 - y
+        x, y, width, height = int(x), int(y), max(int(width), 1), max(int(height), 1)
+
+        surface = self._surface
+        if surface is None or (surface.get_width(), surface.get_height()) != (width, height):
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            self.__dict__['_surface'] = surface
+
+        surface.flush()
+        pixels = np.ndarray(shape=(height, surface.get_stride() // 4), dtype=np.uint32,
+                            buffer=surface.get_data())
+        pixels[:] = 0
+
+        columns = (self.positions[:n, 0] - x).astype(np.intp)
+        rows = (self.positions[:n, 1] - y).astype(np.intp)
+        inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+
+        # premultiplied native-endian ARGB, the way cairo keeps it
+        alphas = self._get_alphas()[inside]
+        rgb = (self.colors[:n, :3][inside] * alphas[:, None] * 255).astype(np.uint32)
+        pixels[rows[inside], columns[inside]] = (alphas * 255).astype(np.uint32) << 24 | \
+                                                rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2]
+        surface.mark_dirty()
+
+        self.graphics.set_source_surface(surface, x, y)
+        self.graphics.rectangle(x, y, width, height)
+        self.graphics.fill()
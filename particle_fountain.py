@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+# Copyright (C) 2014 Toms Bauģis <toms.baugis at gmail.com>
+
+"""
+    Fountain of particles following the mouse, drawn by the numpy backed
+    particle system. Press space to switch between circles, squares and
+    single pixels - the latter keep up with a hundred thousand particles.
+"""
+
+import time
+
+from gi.repository import Gtk as gtk
+from lib import graphics
+from lib import particles
+
+
+class Scene(graphics.Scene):
+    def __init__(self):
+        graphics.Scene.__init__(self, background_color="#333")
+
+        self.particles = particles.ParticleSystem(capacity=100000,
+                                                  forces=[particles.gravity(0, 300)],
+                                                  damping=0.2)
+        self.emitter = self.particles.add_emitter(
+            particles.Emitter(rate=20000, speed=(100, 300), angle=(-2.2, -0.9),
+                              lifetime=(2, 4), color="#7fbfff", size=(1, 4)))
+        self.add_child(self.particles)
+
+        self.last_frame = None
+        self.connect("on-mouse-move", self.on_mouse_move)
+        self.connect("on-key-press", self.on_key_press)
+        self.connect("on-enter-frame", self.on_enter_frame)
+
+    def on_mouse_move(self, scene, event):
+        self.emitter.x, self.emitter.y = event.x, event.y
+
+    def on_key_press(self, scene, event):
+        if event.string == " ":
+            shapes = ["circle", "square", "pixel"]
+            self.particles.shape = shapes[(shapes.index(self.particles.shape) + 1) % len(shapes)]
+
+    def on_enter_frame(self, scene, context):
+        now = time.time()
+        dt = min(now - (self.last_frame or now), 0.1)
+        self.last_frame = now
+
+        self.particles.step(dt)
+
+
+window = gtk.Window()
+window.set_size_request(800, 600)
+window.connect("delete_event", lambda *args: gtk.main_quit())
+window.add(Scene())
+window.show_all()
+import signal
+signal.signal(signal.SIGINT, signal.SIG_DFL) # gtk3 screws up ctrl+c
+gtk.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+# Copyright (C) 2010 Toms Bauģis <toms.baugis at gmail.com>
+
+"""Compares how long it takes to create lots of sprites, how much memory
+they take and how long the first frame takes to render for the regular
+Sprite and the slotted LightSprite. Runs headless on an offscreen scene"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from lib import graphics
+
+
+def make_sprite(i):
+    sprite = graphics.Sprite(x=i % 100 * 8, y=i // 100 * 8)
+    sprite.graphics.rectangle(0, 0, 5, 5)
+    sprite.graphics.fill("#f00")
+    return sprite
+
+def make_light_sprite(i, dot=graphics.Graphics()):
+    if not dot._has_instructions():
+        dot.rectangle(0, 0, 5, 5)
+        dot.fill("#f00")
+    return graphics.LightSprite(dot, x=i % 100 * 8, y=i // 100 * 8)
+
+
+def run(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    sprites = [factory(i) for i in range(count)]
+    created = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    scene = graphics.OffscreenScene(800, 800)
+    start = time.perf_counter()
+    scene.add_child(*sprites)
+    scene.render_frame()
+    rendered = time.perf_counter() - start
+
+    return created, memory, rendered
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    print("%d sprites" % count)
+    print("%-12s %10s %12s %12s" % ("", "create, s", "memory, MB", "render, s"))
+    for label, factory in (("Sprite", make_sprite), ("LightSprite", make_light_sprite)):
+        created, memory, rendered = run(factory, count)
+        print("%-12s %10.3f %12.1f %12.3f" % (label, created, memory / 1024.0 / 1024, rendered))
+    print("memory is the python side only, gobject allocations are not included")
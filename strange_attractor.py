@@ -43,6 +43,7 @@ class Scene(graphics.Scene):
             g.fill_area(0,0, self.width, self.height, "#fff")
 
 
+        points = []
         for i in range(1000):
             self.x = math.sin(self.a * self.y) - math.cos(self.b * self.x)
             self.y = math.sin(self.c * self.x) - math.cos(self.d * self.y)
@@ -50,8 +51,9 @@ class Scene(graphics.Scene):
             x = int(self.x * self.width * 0.2 + self.width / 2)
             y = int(self.y * self.height * 0.2  + self.height / 2)
 
-            g.rectangle(x, y, 1, 1)
+            points.extend((x, y))
 
+        g.points(points)
         g.fill("#000", 0.08)
 
         self.prev_width, self.prev_height = self.width, self.height
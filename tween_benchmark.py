@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# - coding: utf-8 -
+# Copyright (C) 2010 Toms Bauģis <toms.baugis at gmail.com>
+
+"""Measures how many sprite attribute writes per second the tweener gets
+through when animating lots of sprites. Runs headless on an offscreen scene
+and compares lib/graphics.py as it is now against the one in the given git
+revision, which is loaded as a separate module next to it. Every write goes
+through the full Sprite.__setattr__ of each version, invalidation included.
+
+    python tween_benchmark.py [revision [sprites [frames]]]
+
+The revision defaults to HEAD, so that uncommitted changes are measured
+against the last commit"""
+
+import os
+import subprocess
+import sys
+import time
+import types
+
+from lib import graphics
+from lib.pytweener import Easing
+
+
+def load_graphics(revision):
+    """imports lib/graphics.py of the git revision as lib.graphics_<revision>"""
+    source = subprocess.check_output(["git", "show", "%s:lib/graphics.py" % revision],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # a module name of its own keeps the gobject type names apart
+    name = "lib.graphics_%s" % "".join(c if c.isalnum() else "_" for c in revision)
+    module = types.ModuleType(name)
+    module.__package__ = "lib" # for the relative pytweener import
+    sys.modules[name] = module
+    exec(compile(source, "%s:lib/graphics.py" % revision, "exec"), module.__dict__)
+    return module
+
+
+def run(graphics, count, frames):
+    scene = graphics.OffscreenScene(800, 600)
+    for i in range(count):
+        sprite = graphics.Sprite(x=i % 800, y=i % 600)
+        sprite.graphics.rectangle(0, 0, 5, 5)
+        sprite.graphics.fill("#f00")
+        scene.add_child(sprite)
+
+    for i, sprite in enumerate(scene.sprites):
+        scene.animate(sprite, duration=frames, easing=Easing.Linear.ease_in,
+                      x=(i * 7) % 800, y=(i * 13) % 600, rotation=3, scale_x=2, scale_y=2)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        scene.tweener.update(1)
+    duration = time.perf_counter() - start
+
+    return count * frames * 5 / duration
+
+
+if __name__ == '__main__':
+    revision = sys.argv[1] if len(sys.argv) > 1 else "HEAD"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    frames = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    baseline = run(load_graphics(revision), count, frames)
+    current = run(graphics, count, frames)
+
+    print("%d sprites, %d frames, 5 tweened attributes each" % (count, frames))
+    print("%-10s  %10.0f writes/s" % (revision + ":", baseline))
+    print("%-10s  %10.0f writes/s (%.2fx)" % ("current:", current, current / baseline))